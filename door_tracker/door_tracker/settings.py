@@ -61,6 +61,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'webui.middleware.QueryInstrumentationMiddleware',
 ]
 
 # Database backups
@@ -109,6 +110,26 @@ if dj_database_url.DEFAULT_ENV in os.environ:
         conn_health_checks=True,
     )
 
+# Production SQLite: WAL lets requests read while another writes, writers
+# wait for the lock (busy_timeout) and take it when their transaction
+# begins instead of failing to upgrade to it later (IMMEDIATE), and scans
+# are written by a single writer thread (see webui.writer).
+SQLITE_PRODUCTION = os.getenv('DJANGO_SQLITE_PRODUCTION', '') == 'True'
+
+if SQLITE_PRODUCTION and DATABASES['default']['ENGINE'].endswith('sqlite3'):
+    DATABASES['default'].setdefault('OPTIONS', {}).update(
+        {
+            'init_command': (
+                'PRAGMA journal_mode=WAL;'
+                'PRAGMA synchronous=NORMAL;'
+                'PRAGMA busy_timeout=10000;'
+                'PRAGMA mmap_size=268435456;'
+            ),
+            'transaction_mode': 'IMMEDIATE',
+        }
+    )
+    SCAN_WRITER = True
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -157,6 +178,60 @@ STORAGES = {
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
+# Metrics
+# Directory shared by all worker processes, so that /metrics adds up their
+# counters. Without it, /metrics only counts the process that serves it.
+
+METRICS_DIR = os.getenv('DJANGO_METRICS_DIR')
+
+# Bearer token Prometheus sends to scrape /metrics. Without one, only staff
+# can see them.
+
+METRICS_TOKEN = os.getenv('DJANGO_METRICS_TOKEN')
+
+
+# Cache
+# Rate limits and the responses to repeated scans are kept in the cache.
+# Set DJANGO_CACHE_DIR to a directory all worker processes can write to,
+# so that they share them; otherwise every process has its own.
+
+if cache_dir := os.getenv('DJANGO_CACHE_DIR'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': cache_dir,
+        }
+    }
+
+
+# Rate limits
+# Behind a reverse proxy, the META key of the header it passes the client
+# address in, e.g. HTTP_X_FORWARDED_FOR; see webui.ratelimit. Leave it unset
+# when clients connect directly, since they could set the header themselves.
+
+SCAN_ADDRESS_HEADER = os.getenv('DJANGO_SCAN_ADDRESS_HEADER')
+
+
+# Logging
+# https://docs.djangoproject.com/en/5.2/topics/logging/
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        # one line per request with its query count, see webui.middleware;
+        # set DJANGO_QUERY_LOG_LEVEL=INFO to turn it on
+        'webui.middleware': {
+            'handlers': ['console'],
+            'level': os.getenv('DJANGO_QUERY_LOG_LEVEL', 'WARNING'),
+        },
+    },
+}
+
+
 # Production
 
 if not DEBUG:
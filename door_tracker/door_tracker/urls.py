@@ -24,4 +24,6 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('webui.urls')),
     path('register_scan/', views.register_scan, name='register_scan'),
+    path('register_scan_async/', views.aregister_scan, name='aregister_scan'),
+    path('register_scans/', views.register_scans, name='register_scans'),
 ]
@@ -1,39 +1,204 @@
 # admin.py
+import heapq
 import secrets
 from datetime import datetime, timedelta
 
+from django import forms
 from django.contrib import admin
-from django.contrib.auth.models import User
+from django.contrib.admin import helpers
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.utils import quote
+from django.contrib.admin.views.main import ChangeList
+from django.contrib.admin.widgets import AutocompleteSelect
 from django.core.cache import cache
-from django.http import HttpResponseRedirect, JsonResponse
+from django.db import connection, transaction
+from django.db.models import Q
+from django.http import JsonResponse
+from django.template.response import TemplateResponse
 from django.urls import path, reverse
-
-from .models import Job, Log, Membership, Scanner, SubTeam, Tag
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from . import reports
+from .models import (
+    ArchivedLog,
+    Job,
+    Log,
+    Membership,
+    Scanner,
+    ScheduledTask,
+    SubTeam,
+    Tag,
+    TaskRun,
+    log_order,
+    replay_logs,
+    save_log,
+)
+from .views import CursorField, logs_csv_response
 
 admin.site.site_header = 'RoboTeam'
 TOKEN_LIFETIME = 24 * 360  # How long until the link expires
 
 
-class LogSubteamListFilter(admin.SimpleListFilter):
-    title = 'subteam'
-    parameter_name = 'subteam'
+# logs per admin page are fetched after this cursor instead of by page number
+CURSOR_VAR = 'before'
+
+# counts of filtered logs stop here, so that counting never scans the table
+MAX_COUNT = 10_000
+
+
+def estimated_count(queryset):
+    """
+    Returns (count, exact). Unfiltered tables are estimated from the
+    PostgreSQL statistics; anything else is counted up to MAX_COUNT.
+    """
+    if not queryset.query.has_filters() and connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                [queryset.model._meta.db_table],
+            )
+            [estimate] = cursor.fetchone()
+        if estimate >= 0:  # -1 before the table is first analyzed
+            return estimate, False
+    count = queryset.order_by()[: MAX_COUNT + 1].count()
+    return min(count, MAX_COUNT), count <= MAX_COUNT
+
+
+class LogChangeList(ChangeList):
+    """
+    Pages through logs newest first with a (time, id) cursor, so that a page
+    costs the same however deep it is and however many logs there are.
+    Pages merge the live logs with the archived ones, which keep their ids,
+    so the cursor works across both.
+    """
+
+    def get_filters_params(self, params=None):
+        params = super().get_filters_params(params)
+        params.pop(CURSOR_VAR, None)
+        return params
+
+    def get_ordering(self, request, queryset):
+        return ['-time', '-pk']
+
+    def get_archived_queryset(self, request):
+        """The archived logs matching the filters and search of this page."""
+        root_queryset = self.root_queryset
+        self.root_queryset = ArchivedLog.objects.all()
+        try:
+            return self.get_queryset(request)
+        finally:
+            self.root_queryset = root_queryset
+
+    def get_results(self, request):
+        self.archived_queryset = self.get_archived_queryset(request)
+        tiers = [self.queryset, self.archived_queryset]
+        self.cursor = None
+        if cursor := request.GET.get(CURSOR_VAR):
+            try:
+                self.cursor = CursorField().to_internal_value(cursor)
+            except ValidationError:
+                raise IncorrectLookupParameters
+            time, pk = self.cursor
+            after = Q(time__lt=time) | Q(time=time, pk__lt=pk)
+            tiers = [queryset.filter(after) for queryset in tiers]
+
+        # each tier is sorted newest first, a recent page costs the archive
+        # one empty index lookup
+        newest = [queryset[: self.list_per_page + 1] for queryset in tiers]
+        page = list(heapq.merge(*newest, key=log_order, reverse=True))
+        page = page[: self.list_per_page + 1]
+        self.result_list = page[: self.list_per_page]
+        self.newest_url = self.get_query_string(remove=[CURSOR_VAR])
+        self.older_url = None
+        if len(page) > self.list_per_page:
+            last = self.result_list[-1]
+            cursor = CursorField().to_representation((last.time, last.pk))
+            self.older_url = self.get_query_string({CURSOR_VAR: cursor})
+
+        live_count, live_exact = estimated_count(self.queryset)
+        archived_count, archived_exact = estimated_count(self.archived_queryset)
+        self.result_count = live_count + archived_count
+        exact = live_exact and archived_exact
+        if exact:
+            self.result_count_display = str(self.result_count)
+        elif self.queryset.query.has_filters() or connection.vendor != 'postgresql':
+            # counted up to MAX_COUNT
+            self.result_count_display = f'{self.result_count}+'
+        else:
+            self.result_count_display = f'~{self.result_count}'
+
+        self.show_full_result_count = False
+        self.full_result_count = None
+        self.show_admin_actions = True
+        self.can_show_all = False
+        self.multi_page = False
+        self.paginator = None
+
+    def url_for_result(self, result):
+        if isinstance(result, ArchivedLog):
+            return reverse(
+                'admin:webui_archivedlog_change',
+                args=(quote(result.pk),),
+                current_app=self.model_admin.admin_site.name,
+            )
+        return super().url_for_result(result)
+
+
+class AutocompleteListFilter(admin.SimpleListFilter):
+    """
+    Filters on one object picked in an autocomplete box, instead of listing
+    every object in the sidebar. The box searches the model that `field`
+    points to, whose admin needs search_fields.
+    """
+
+    template = 'admin/webui/autocomplete_filter.html'
+    field = None
+
+    def __init__(self, request, params, model, model_admin):
+        super().__init__(request, params, model, model_admin)
+        self.admin_site = model_admin.admin_site
 
     def lookups(self, request, model_admin):
-        return [(s.id, s) for s in SubTeam.objects.all()]
+        return ()
+
+    def has_output(self):
+        return True
+
+    def choices(self, changelist):
+        form_field = forms.ModelChoiceField(
+            queryset=self.field.remote_field.model._default_manager.all(),
+            widget=AutocompleteSelect(self.field, self.admin_site),
+            required=False,
+        )
+        yield {
+            'query_string': changelist.get_query_string(
+                remove=[self.parameter_name, CURSOR_VAR]
+            ),
+            'parameter_name': self.parameter_name,
+            'widget': form_field.widget.render(
+                self.parameter_name,
+                self.value(),
+                attrs={'id': f'filter_{self.parameter_name}'},
+            ),
+        }
+
+
+class LogSubteamListFilter(AutocompleteListFilter):
+    title = 'subteam'
+    parameter_name = 'subteam'
+    field = Membership._meta.get_field('subteam')
 
     def queryset(self, request, queryset):
         if not self.value():
             return queryset
-        members = Membership.objects.filter_effective().filter(subteam=self.value())
-        return queryset.filter(tag__owner__in=members.values('person'))
+        return Membership.objects.filter_logs(queryset, self.value())
 
 
-class LogPersonListFilter(admin.SimpleListFilter):
+class LogPersonListFilter(AutocompleteListFilter):
     title = 'person'
     parameter_name = 'person'
-
-    def lookups(self, request, model_admin):
-        return [(u.id, u.get_full_name()) for u in User.objects.all()]
+    field = Membership._meta.get_field('person')
 
     def queryset(self, request, queryset):
         if not self.value():
@@ -41,24 +206,127 @@ class LogPersonListFilter(admin.SimpleListFilter):
         return queryset.filter(tag__owner=self.value())
 
 
+def selected_archived_logs(modeladmin, request):
+    """The archived logs selected on the changelist, next to the live ones."""
+    if request.POST.get('select_across') == '1':
+        return modeladmin.get_changelist_instance(request).archived_queryset
+    selected = request.POST.getlist(helpers.ACTION_CHECKBOX_NAME)
+    return ArchivedLog.objects.filter(pk__in=selected)
+
+
+@admin.action(description='Export selected logs as CSV')
 def export_selected_logs(modeladmin, request, queryset):
-    ids = queryset.values_list('pk', flat=True)
-    url = reverse('export', query={'ids': ids})
-    return HttpResponseRedirect(url)
+    return logs_csv_response(selected_archived_logs(modeladmin, request), queryset)
+
+
+@admin.action(description='Export selected logs as gzipped CSV')
+def export_selected_logs_gzip(modeladmin, request, queryset):
+    return logs_csv_response(
+        selected_archived_logs(modeladmin, request), queryset, gzip=True
+    )
+
+
+def owners(logs):
+    return set(logs.exclude(tag__owner=None).values_list('tag__owner', flat=True))
 
 
 @admin.register(Log)
 class LogAdmin(admin.ModelAdmin):
-    actions = [export_selected_logs]
+    actions = [export_selected_logs, export_selected_logs_gzip]
     list_display = ('time', 'type', 'person', 'scanner')
     list_filter = (LogSubteamListFilter, LogPersonListFilter)
-    ordering = ('-time',)
+    # Log.__str__ and Log.person() read the tag and its owner
+    list_select_related = ('scanner', 'tag__owner')
+    ordering = ('-time', '-pk')
     search_fields = ('tag__owner__username', 'type')
+    sortable_by = ()
+
+    @property
+    def media(self):
+        widget = AutocompleteSelect(LogPersonListFilter.field, self.admin_site)
+        return super().media + widget.media
+
+    def get_changelist(self, request, **kwargs):
+        return LogChangeList
+
+    # presences and sessions follow the logs: new logs go through save_log(),
+    # other edits replay the logs of the people they concern
+
+    def save_model(self, request, obj, form, change):
+        with transaction.atomic():
+            if not change:
+                save_log(obj)
+                # unless it's the latest log of its owner, it's out of order
+                if (
+                    obj.tag
+                    and obj.tag.owner_id is not None
+                    and obj.tag.owner.presence.last_log_id != obj.pk
+                ):
+                    replay_logs([obj.tag.owner_id])
+                return
+            people = owners(Log.objects.filter(pk=obj.pk))
+            obj.save()
+            replay_logs(people | owners(Log.objects.filter(pk=obj.pk)))
+
+    def delete_model(self, request, obj):
+        self.delete_queryset(request, Log.objects.filter(pk=obj.pk))
+
+    def delete_queryset(self, request, queryset):
+        with transaction.atomic():
+            people = owners(queryset)
+            queryset.delete()
+            replay_logs(people)
+
+
+@admin.register(ArchivedLog)
+class ArchivedLogAdmin(admin.ModelAdmin):
+    """Read only. Archived logs are also listed with the live ones."""
+
+    list_display = ('time', 'type', 'person', 'scanner')
+    list_select_related = ('scanner', 'tag__owner')
+    ordering = ('-time', '-pk')
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(ScheduledTask)
+class ScheduledTaskAdmin(admin.ModelAdmin):
+    """Set next_run to now to run a task at the next tick of the scheduler."""
+
+    list_display = ('name', 'next_run', 'leased_by', 'leased_until')
+    fields = ('name', 'next_run', 'leased_by', 'leased_until')
+    readonly_fields = ('name', 'leased_by', 'leased_until')
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(TaskRun)
+class TaskRunAdmin(admin.ModelAdmin):
+    """Read only. Written by the scheduler after each run."""
+
+    list_display = ('task', 'started', 'duration', 'succeeded', 'worker')
+    list_filter = ('task', 'succeeded')
+    ordering = ('-started',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
 
 
 @admin.register(Membership)
 class MembershipAdmin(admin.ModelAdmin):
-    list_display = ('starting_from', 'person', 'subteam', 'job')
+    list_display = ('starting_from', 'valid_until', 'person', 'subteam', 'job')
     ordering = ('-starting_from',)
     search_fields = ('person__username', 'subteam__name')
 
@@ -71,16 +339,19 @@ class TagAdmin(admin.ModelAdmin):
 @admin.register(SubTeam)
 class NamedAdmin(admin.ModelAdmin):
     list_display = ('name',)
+    ordering = ('name',)
+    search_fields = ('name',)  # for the log subteam filter
 
 
 @admin.register(Job)
 class JobAdmin(admin.ModelAdmin):
+    change_list_template = 'admin/webui/job/change_list.html'
     list_display = ('name', 'quota')
 
 
 @admin.register(Scanner)
 class ScannerAdmin(admin.ModelAdmin):
-    list_display = ('name', 'id')
+    list_display = ('name', 'id', 'scans_per_minute', 'scan_burst')
 
     def get_readonly_fields(self, request, obj=None):
         default = super().get_readonly_fields(request, obj)
@@ -105,6 +376,30 @@ def generate_register_link(request):
     return JsonResponse({'link': link, 'expires_at': expires_at})
 
 
+class QuotaReportForm(forms.Form):
+    unit = forms.ChoiceField(choices=[(unit, unit.title()) for unit in reports.UNITS])
+    date = forms.DateField(
+        required=False, widget=forms.DateInput(attrs={'type': 'date'})
+    )
+
+
+def quota_report(request):
+    form = QuotaReportForm(request.GET or None)
+    params = form.cleaned_data if form.is_valid() else {}
+    unit = params.get('unit', 'week')
+    day = params.get('date') or timezone.localdate()
+    context = {
+        **admin.site.each_context(request),
+        'title': 'Quota report',
+        'form': form if form.is_bound else QuotaReportForm(initial={'unit': unit}),
+        'report': reports.report(day, unit),
+        'csv_url': reverse(
+            'quota_report', query={'unit': unit, 'date': day, 'csv': 'true'}
+        ),
+    }
+    return TemplateResponse(request, 'admin/webui/quota_report.html', context)
+
+
 # admin.py (at the bottom)
 def get_urls(original_get_urls):
     def custom_get_urls(self):
@@ -115,6 +410,11 @@ def get_urls(original_get_urls):
                 self.admin_view(generate_register_link),
                 name='generate_register_link',
             ),
+            path(
+                'quota-report/',
+                self.admin_view(quota_report),
+                name='quota_report',
+            ),
         ]
         return custom_urls + urls
 
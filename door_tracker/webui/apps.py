@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class WebuiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'webui'
+
+    def ready(self):
+        from . import middleware, occupancy, scan_cache  # noqa: F401 (connect signal receivers)
@@ -0,0 +1,104 @@
+"""
+In-process pub/sub of new logs, for the server-sent events feed.
+
+Saving logs publishes them to the hub once their transaction commits, and
+the hub hands them to the queue of every connected browser that may see
+them, without any query. Browsers only hear about logs written by the
+worker process they are connected to, so deployments with several workers
+should run the scanner endpoints and the feed in the same ASGI process.
+"""
+
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# events a browser may fall behind by before it's told to reload instead
+QUEUE_SIZE = 1000
+
+# sent instead of the events a browser missed when its queue was full
+RESET = object()
+
+
+def log_event(log):
+    """A log as current_user_data returns it."""
+    return {
+        'id': log.id,
+        'type': log.get_type_display(),
+        'time': log.time.isoformat(),
+        'tag': str(log.tag),
+        'user_id': log.tag.owner_id if (log.tag and log.tag.owner_id) else None,
+    }
+
+
+class Subscription:
+    def __init__(self, loop, user_id):
+        self.loop = loop
+        self.user_id = user_id
+        self.queue = asyncio.Queue(QUEUE_SIZE)
+
+    def wants(self, event):
+        return self.user_id is None or event['user_id'] == self.user_id
+
+    def put(self, events):
+        """Runs on the subscriber's event loop."""
+        for event in events:
+            try:
+                self.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                while not self.queue.empty():
+                    self.queue.get_nowait()
+                self.queue.put_nowait(RESET)
+                return
+
+
+class Hub:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = set()
+        self.listeners = []
+
+    def connect(self, listener):
+        """Call listener(logs) in the publishing thread for every publish."""
+        self.listeners.append(listener)
+        return listener
+
+    def subscribe(self, user_id=None):
+        """
+        Start receiving the events of user_id's logs, or of all logs if
+        user_id is None. Must be called from the event loop that reads the
+        queue.
+        """
+        subscription = Subscription(asyncio.get_running_loop(), user_id)
+        with self.lock:
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def publish(self, logs):
+        """Hand logs to their subscribers. Safe to call from any thread."""
+        for listener in self.listeners:
+            try:
+                listener(logs)
+            except Exception:
+                # the logs are committed already, don't fail the request
+                logger.exception('%r failed to handle new logs', listener)
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        if not subscriptions:
+            return
+        events = [log_event(log) for log in logs]
+        for subscription in subscriptions:
+            if not (wanted := [e for e in events if subscription.wants(e)]):
+                continue
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, wanted)
+            except RuntimeError:
+                pass  # the server is shutting down and closed the loop
+
+
+hub = Hub()
@@ -0,0 +1,277 @@
+"""
+Load generator for a running door tracker server.
+
+Every simulated client holds its own keep-alive HTTP connection, the way a
+scanner does, and sends requests back to back until the run is over.
+"""
+
+import http.client
+import json
+import random
+import threading
+import time
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import DatabaseError, connection, transaction
+from django.test import Client as DjangoClient
+from django.test.utils import CaptureQueriesContext
+
+from .models import Scanner, Tag
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return None
+    k = max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))
+    return values[k]
+
+
+def milliseconds(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+class Client:
+    def __init__(self, base_url, timeout=30):
+        url = urlsplit(base_url)
+        cls = (
+            http.client.HTTPSConnection
+            if url.scheme == 'https'
+            else http.client.HTTPConnection
+        )
+        self.connection = cls(url.netloc, timeout=timeout)
+        self.prefix = url.path.rstrip('/')
+
+    def request(self, method, path, body=None, headers=None):
+        """Returns the status code and latency in seconds of one request."""
+        headers = dict(headers or {})
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        start = time.perf_counter()
+        try:
+            self.connection.request(method, self.prefix + path, body, headers)
+            response = self.connection.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            status = None
+        return status, time.perf_counter() - start
+
+    def close(self):
+        self.connection.close()
+
+
+class Results:
+    """Latencies and status codes collected by many threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.statuses = {}
+
+    def add(self, status, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def summary(self, elapsed):
+        latencies = sorted(self.latencies)
+        errors = sum(n for s, n in self.statuses.items() if s is None or s >= 500)
+        return {
+            'requests': len(latencies),
+            'errors': errors,
+            # refused by the rate limits: fast, but not served
+            'rate_limited': self.statuses.get(429, 0),
+            'throughput': round(len(latencies) / elapsed, 2),
+            'p50_ms': milliseconds(percentile(latencies, 50)),
+            'p95_ms': milliseconds(percentile(latencies, 95)),
+            'p99_ms': milliseconds(percentile(latencies, 99)),
+            'statuses': {str(s): n for s, n in sorted(self.statuses.items(), key=str)},
+        }
+
+
+class QueryCounts:
+    """Database queries per request of every endpoint, from many threads."""
+
+    # what a probe's own transaction adds to a request, not counted
+    TRANSACTION_CONTROL = ('BEGIN', 'SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, name, queries):
+        n = sum(
+            1
+            for query in queries
+            if not query['sql'].startswith(self.TRANSACTION_CONTROL)
+        )
+        with self.lock:
+            self.counts.setdefault(name, []).append(n)
+
+    def summary(self, name):
+        counts = sorted(self.counts.get(name, []))
+        return {
+            'queries': percentile(counts, 50),
+            'queries_max': counts[-1] if counts else None,
+        }
+
+
+def device_ids(n):
+    """One scanner per simulated scanner, so that per-scanner paths count."""
+    return [f'loadtest-{i}' for i in range(n)]
+
+
+def card_ids(n):
+    return [f'loadtest-{i}'.encode() for i in range(n)]
+
+
+def scan_body(device_id, card_id):
+    return {'device_id': device_id, 'card_id': b64encode(card_id).decode()}
+
+
+def users(n):
+    """The first n users created by setup()."""
+    users = User.objects.filter(username__startswith='loadtest-').order_by('pk')
+    return list(users[:n])
+
+
+def session_id(user):
+    """Log user in and return the session cookie, as a browser would hold."""
+    client = DjangoClient()
+    client.force_login(user)
+    return client.cookies[settings.SESSION_COOKIE_NAME].value
+
+
+def setup(cards, devices=()):
+    """
+    Create the load test scanners, and a user with a claimed tag per card.
+    Returns the users.
+    """
+    for device_id in devices:
+        Scanner.objects.get_or_create(
+            id=device_id, defaults={'name': f'Load test {device_id}'}
+        )
+    users = []
+    for i, card_id in enumerate(cards):
+        user, _ = User.objects.get_or_create(
+            username=f'loadtest-{i}',
+            defaults={'first_name': 'Load', 'last_name': f'Test {i}'},
+        )
+        Tag.objects.get_or_create(
+            tag=card_id, defaults={'name': 'load test', 'owner': user}
+        )
+        users.append(user)
+    return users
+
+
+def pace(rate):
+    """
+    Generator that sleeps so that the loop driving it runs rate times per
+    second. A rate of 0 doesn't sleep at all.
+    """
+    next_at = time.monotonic()
+    while True:
+        if rate:
+            next_at += 1 / rate
+            time.sleep(max(0, next_at - time.monotonic()))
+        yield
+
+
+def scanner_loop(base_url, path, device_id, cards, deadline, results, rate=0):
+    """A scanner swiping random cards, rate times per second."""
+    client = Client(base_url)
+    try:
+        for _ in pace(rate):
+            if time.monotonic() >= deadline:
+                break
+            body = scan_body(device_id, random.choice(cards))
+            results.add(*client.request('POST', path, body))
+    finally:
+        client.close()
+
+
+def browser_loop(base_url, session_id, paths, deadline, results, think_time=0):
+    """
+    A logged in dashboard user requesting every (name, path) in turn and
+    pausing think_time seconds in between.
+    """
+    client = Client(base_url)
+    headers = {'Cookie': f'{settings.SESSION_COOKIE_NAME}={session_id}'}
+    try:
+        while time.monotonic() < deadline:
+            for name, path in paths:
+                results[name].add(*client.request('GET', path, headers=headers))
+                time.sleep(think_time)
+    finally:
+        client.close()
+
+
+# the test client swaps the request signal handlers of every thread while
+# it runs a request, so probes take turns
+probe_lock = threading.Lock()
+
+
+def probe_loop(requests, deadline, counts, pause=0):
+    """
+    Make every (name, request) in turn in this process while the load runs,
+    counting the queries of each on this thread's connection. request()
+    returns the response. Every request
+    is rolled back, so probes don't leave logs behind. Pause pause seconds
+    in between.
+    """
+    try:
+        while time.monotonic() < deadline:
+            for name, request in requests:
+                try:
+                    with (
+                        probe_lock,
+                        CaptureQueriesContext(connection) as ctx,
+                        transaction.atomic(),
+                    ):
+                        response = request()
+                        transaction.set_rollback(True)
+                except DatabaseError:
+                    # lost the race for the lock, as the server's requests
+                    # can without DJANGO_SQLITE_PRODUCTION: nothing to count
+                    pass
+                else:
+                    # refused by the rate limits before any query
+                    if response.status_code != 429:
+                        counts.add(name, ctx.captured_queries)
+                time.sleep(pause)
+    finally:
+        connection.close()
+
+
+def run(workers, duration):
+    """
+    Call every worker(deadline) in its own thread until duration seconds
+    have passed. Returns the elapsed time.
+    """
+    deadline = time.monotonic() + duration
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max(1, len(workers))) as pool:
+        for future in [pool.submit(worker, deadline) for worker in workers]:
+            future.result()
+    return time.perf_counter() - start
+
+
+def run_scanners(base_url, path, cards, connections, duration):
+    """
+    Hammer path with connections concurrent scanners for duration seconds
+    and return the summary of the run.
+    """
+    results = Results()
+    workers = [
+        partial(scanner_loop, base_url, path, device_id, cards, results=results)
+        for device_id in device_ids(connections)
+    ]
+    return results.summary(run(workers, duration))
@@ -0,0 +1,38 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from webui import utils
+from webui.models import ArchivedLog
+
+
+class Command(BaseCommand):
+    help = """
+    Move logs older than LOG_RETENTION_DAYS (365 by default) from the Log
+    table to the archive. Export and the admin read both tables, and
+    statistics come from sessions, so nothing visible changes. Safe to run
+    every night, e.g. from cron: `django archive_logs`.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--before',
+            type=date.fromisoformat,
+            help='Archive the logs before this day (YYYY-MM-DD). '
+            'Defaults to LOG_RETENTION_DAYS days ago.',
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, before=None, batch_size=1000, **options):
+        horizon = ArchivedLog.objects.horizon()
+        if before is not None:
+            horizon = utils.start_of_day(before)
+        started = timezone.now()
+        n = ArchivedLog.objects.archive(horizon, batch_size=batch_size)
+        elapsed = (timezone.now() - started).total_seconds()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Archived {n} logs from before {horizon:%Y-%m-%d} in {elapsed:.2f}s.'
+            )
+        )
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from webui.models import Session
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the session table from the live and archived logs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of rows read and written per query.',
+        )
+
+    def handle(self, *args, batch_size=1000, **options):
+        n = Session.objects.rebuild(batch_size=batch_size)
+        self.stdout.write(self.style.SUCCESS(f'Built {n} sessions.'))
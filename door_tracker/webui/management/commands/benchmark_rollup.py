@@ -0,0 +1,208 @@
+import random
+import time
+from datetime import date, timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from webui import loadtest, utils
+from webui.models import Log, Session, Statistics, Tag
+
+
+def compute_by_queries(first, last):
+    """
+    (minutes_day, minutes_week, minutes_month) by (person id, day), with
+    three grouped queries per day, as rollup used to compute them.
+    """
+    rows = {}
+    day = first
+    while day <= last:
+        start, end = utils.day_range(day, day)
+        week_start = utils.start_of_day(day - timedelta(days=day.weekday()))
+        month_start = utils.start_of_day(day.replace(day=1))
+        minutes_day = Session.objects.minutes_by_person(start, end)
+        minutes_week = Session.objects.minutes_by_person(week_start, end)
+        minutes_month = Session.objects.minutes_by_person(month_start, end)
+        for person_id in minutes_month.keys() | minutes_week.keys():
+            rows[person_id, day] = (
+                minutes_day.get(person_id, 0),
+                minutes_week.get(person_id, 0),
+                minutes_month.get(person_id, 0),
+            )
+        day += timedelta(days=1)
+    return rows
+
+
+def minutes_by_loop(first, last):
+    """
+    (minutes_day, pairs) by (person id, day), from the logs of every person
+    and day in turn, paired in a Python loop like the minutes_today view did
+    before sessions were stored. A check-in left open counts until the end
+    of its day (or now), a day starting with a check-out counts from
+    midnight, and each of the pairs is rounded down to whole minutes on its
+    own.
+    """
+    now = timezone.now()
+    people = User.objects.filter(tags__isnull=False).distinct()
+    rows = {}
+    for person in people:
+        day = first
+        while day <= last:
+            start, end = utils.day_range(day, day)
+            logs = Log.objects.filter(
+                tag__owner=person, time__gte=start, time__lt=end
+            ).order_by('time')
+            minutes = pairs = 0
+            checkin = None
+            first_log = True
+            for log in logs:
+                if log.type == Log.LogEntryType.CHECKIN:
+                    checkin = log.time
+                elif log.type == Log.LogEntryType.CHECKOUT:
+                    if checkin is not None:
+                        minutes += int((log.time - checkin).total_seconds() // 60)
+                        pairs += 1
+                        checkin = None
+                    elif first_log:
+                        minutes += int((log.time - start).total_seconds() // 60)
+                        pairs += 1
+                first_log = False
+            if checkin is not None:
+                minutes += int((min(end, now) - checkin).total_seconds() // 60)
+                pairs += 1
+            if pairs:
+                rows[person.pk, day] = minutes, pairs
+            day += timedelta(days=1)
+    return rows
+
+
+def generate_logs(n, people, first, last, batch_size=10_000):
+    """
+    Create about n check-ins and check-outs of load test users, spread over
+    first..last, and rebuild the sessions.
+    """
+    users = loadtest.setup(loadtest.card_ids(people))
+    tags = dict(Tag.objects.filter(owner__in=users).values_list('owner', 'pk'))
+    days = (last - first).days + 1
+    visits = max(1, n // (2 * people * days))
+    rng = random.Random(0)
+
+    def logs():
+        for user in users:
+            for i in range(days):
+                midnight = utils.start_of_day(first + timedelta(days=i))
+                times = sorted(rng.uniform(0, 86400) for _ in range(2 * visits))
+                for j, seconds in enumerate(times):
+                    yield Log(
+                        type='IN' if j % 2 == 0 else 'OUT',
+                        tag_id=tags[user.pk],
+                        time=midnight + timedelta(seconds=seconds),
+                    )
+
+    created = 0
+    batch = []
+    with transaction.atomic():
+        for log in logs():
+            batch.append(log)
+            if len(batch) >= batch_size:
+                created += len(Log.objects.bulk_create(batch))
+                batch = []
+        created += len(Log.objects.bulk_create(batch))
+    Session.objects.rebuild()
+    return created
+
+
+class Command(BaseCommand):
+    help = """
+    Time the vectorized statistics computation of rollup_statistics
+    against three grouped queries per day over the sessions, and against
+    pairing the logs of every person and day in a Python loop like the
+    old minutes_today view. Reports the rows where they disagree. Nothing
+    is written, unless --setup generates a history of load test users
+    first.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--since',
+            type=date.fromisoformat,
+            help='First day to compute (YYYY-MM-DD). Defaults to a year ago.',
+        )
+        parser.add_argument(
+            '--until',
+            type=date.fromisoformat,
+            help='Last day to compute (YYYY-MM-DD). Defaults to yesterday.',
+        )
+        parser.add_argument(
+            '--setup',
+            type=int,
+            metavar='LOGS',
+            help='Generate about this many logs over the range first.',
+        )
+        parser.add_argument('--people', type=int, default=200)
+        parser.add_argument(
+            '--skip-loop',
+            action='store_true',
+            help='Leave out the per-person loop, which takes a query per '
+            'person and day.',
+        )
+
+    def handle(
+        self,
+        *args,
+        since=None,
+        until=None,
+        setup=None,
+        people=200,
+        skip_loop=False,
+        **options,
+    ):
+        until = until or timezone.localdate() - timedelta(days=1)
+        since = since or until - timedelta(days=364)
+        if setup:
+            started = time.perf_counter()
+            n = generate_logs(setup, people, since, until)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f'Generated {n} logs in {elapsed:.1f}s.')
+
+        started = time.perf_counter()
+        rows = Statistics.objects.compute(since, until)
+        one_pass = time.perf_counter() - started
+
+        started = time.perf_counter()
+        expected = compute_by_queries(since, until)
+        by_queries = time.perf_counter() - started
+
+        actual = {
+            key: (row.minutes_day, row.minutes_week, row.minutes_month)
+            for key, row in rows.items()
+        }
+        differences = sum(
+            actual.get(key) != expected.get(key) for key in actual.keys() | expected
+        )
+        logs = Log.objects.count()
+        sessions = Session.objects.count()
+        self.stdout.write(f'{logs} logs, {sessions} sessions, {len(rows)} rows')
+        self.stdout.write(f'vectorized:        {one_pass:8.2f}s')
+        self.stdout.write(f'queries per day:   {by_queries:8.2f}s')
+        style = self.style.SUCCESS if not differences else self.style.ERROR
+        self.stdout.write(style(f'{differences} rows differ.'))
+        if skip_loop:
+            return
+
+        started = time.perf_counter()
+        looped = minutes_by_loop(since, until)
+        by_loop = time.perf_counter() - started
+        days = {key: row.minutes_day for key, row in rows.items() if row.minutes_day}
+        # the loop rounds every pair down on its own, so it may be short by
+        # up to a minute per pair
+        off = 0
+        for key in days.keys() | looped.keys():
+            minutes, pairs = looped.get(key, (0, 0))
+            off += not 0 <= days.get(key, 0) - minutes <= pairs
+
+        self.stdout.write(f'per-person loop:   {by_loop:8.2f}s')
+        style = self.style.SUCCESS if not off else self.style.ERROR
+        self.stdout.write(style(f'{off} day totals differ by more than rounding.'))
@@ -0,0 +1,173 @@
+import json
+import random
+from functools import partial
+
+from django.core.management.base import BaseCommand
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from webui import loadtest
+
+ENDPOINTS = ['check_status', 'utable_data', 'get_statistics']
+
+
+class Command(BaseCommand):
+    help = """
+    Load test a running server with scanners and dashboard users at the
+    same time. N scanners post to register_scan/ at a given swipe rate
+    while M logged in users poll check_status, current_user_data and
+    get_statistics. Reports throughput, latency percentiles and database
+    queries per request for every endpoint, and can save them as JSON to
+    compare runs. Queries are counted by a scanner and a user in this
+    process, against the same database during the run; their requests are
+    rolled back.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000')
+        parser.add_argument('--scanners', type=int, default=10)
+        parser.add_argument(
+            '--swipe-rate',
+            type=float,
+            default=1,
+            help='Swipes per second per scanner, 0 for as fast as possible.',
+        )
+        parser.add_argument('--users', type=int, default=10)
+        parser.add_argument(
+            '--think-time',
+            type=float,
+            default=1,
+            help='Seconds a dashboard user waits between requests.',
+        )
+        parser.add_argument('--duration', type=float, default=30)
+        parser.add_argument('--cards', type=int, default=100)
+        parser.add_argument('--output', help='Write the results to this JSON file.')
+        parser.add_argument(
+            '--setup',
+            action='store_true',
+            help='Create the load test scanners, users and tags in the database.',
+        )
+
+    def handle(self, *args, **options):
+        cards = loadtest.card_ids(max(options['cards'], options['users']))
+        devices = loadtest.device_ids(options['scanners'])
+        if options['setup']:
+            loadtest.setup(cards, devices)
+        users = loadtest.users(options['users'])
+        scan_path = reverse('register_scan')
+        paths = [(name, reverse(name)) for name in ENDPOINTS]
+
+        results = {name: loadtest.Results() for name in ['register_scan', *ENDPOINTS]}
+        workers = [
+            partial(
+                loadtest.scanner_loop,
+                options['url'],
+                scan_path,
+                device_id,
+                cards,
+                results=results['register_scan'],
+                rate=options['swipe_rate'],
+            )
+            for device_id in devices
+        ] + [
+            partial(
+                loadtest.browser_loop,
+                options['url'],
+                loadtest.session_id(user),
+                paths,
+                results=results,
+                think_time=options['think_time'],
+            )
+            for user in users
+        ]
+
+        counts = loadtest.QueryCounts()
+        probes = self.probes(
+            devices[0] if devices else None,
+            cards,
+            users[0] if users else None,
+            counts,
+            options,
+        )
+
+        started_at = timezone.now()
+        # the probes write on their own connection, to roll back
+        with override_settings(
+            ALLOWED_HOSTS=['*'], SECURE_SSL_REDIRECT=False, SCAN_WRITER=False
+        ):
+            elapsed = loadtest.run(workers + probes, options['duration'])
+
+        report = {
+            'started_at': started_at.isoformat(),
+            'elapsed': round(elapsed, 2),
+            'config': {
+                k: options[k]
+                for k in [
+                    'url',
+                    'scanners',
+                    'swipe_rate',
+                    'users',
+                    'think_time',
+                    'duration',
+                ]
+            },
+            'endpoints': {
+                name: {**r.summary(elapsed), **counts.summary(name)}
+                for name, r in results.items()
+            },
+        }
+
+        self.stdout.write(
+            'endpoint         requests  req/s     p50 ms   p95 ms   p99 ms   '
+            'errors  429s    queries (p50/max)'
+        )
+        for name, r in report['endpoints'].items():
+            self.stdout.write(
+                f'{name:<16} {r["requests"]:<9} {r["throughput"]:<9} '
+                f'{r["p50_ms"]!s:<8} {r["p95_ms"]!s:<8} {r["p99_ms"]!s:<8} '
+                f'{r["errors"]:<7} {r["rate_limited"]:<7} '
+                f'{r["queries"]}/{r["queries_max"]}'
+            )
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+
+    def probes(self, device_id, cards, user, counts, options):
+        """
+        Workers that make the requests of a scanner and of a dashboard user
+        in process, to count their queries while the server is under load.
+        """
+        probes = []
+        if device_id is not None:
+            scanner = Client()
+
+            def scan():
+                return scanner.post(
+                    reverse('register_scan'),
+                    loadtest.scan_body(device_id, random.choice(cards)),
+                    content_type='application/json',
+                )
+
+            rate = options['swipe_rate']
+            probes.append(
+                partial(
+                    loadtest.probe_loop,
+                    [('register_scan', scan)],
+                    counts=counts,
+                    pause=1 / rate if rate else 0,
+                )
+            )
+        if user is not None:
+            browser = Client()
+            browser.force_login(user)
+            probes.append(
+                partial(
+                    loadtest.probe_loop,
+                    [(name, partial(browser.get, reverse(name))) for name in ENDPOINTS],
+                    counts=counts,
+                    pause=options['think_time'],
+                )
+            )
+        return probes
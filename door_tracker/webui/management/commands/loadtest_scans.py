@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand
+
+from webui import loadtest
+
+
+class Command(BaseCommand):
+    help = """
+    Measure how many concurrent scanner connections a running server can
+    serve. Start the server in another terminal, e.g. the WSGI path with
+    `django runserver --noreload` or the ASGI path with
+    `daphne door_tracker.asgi:application`, then run this command against
+    register_scan/ or register_scan_async/.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000')
+        parser.add_argument(
+            '--path',
+            default='/register_scan/',
+            help='/register_scan/ (sync) or /register_scan_async/ (async).',
+        )
+        parser.add_argument(
+            '--connections',
+            type=int,
+            nargs='+',
+            default=[1, 10, 50, 100],
+            help='Numbers of concurrent scanners to try, in order.',
+        )
+        parser.add_argument(
+            '--duration', type=float, default=10, help='Seconds per step.'
+        )
+        parser.add_argument('--cards', type=int, default=100)
+        parser.add_argument(
+            '--setup',
+            action='store_true',
+            help='Create the load test scanners, users and tags in the database.',
+        )
+
+    def handle(self, *args, **options):
+        cards = loadtest.card_ids(options['cards'])
+        if options['setup']:
+            loadtest.setup(cards, loadtest.device_ids(max(options['connections'])))
+
+        self.stdout.write(f'{options["url"]}{options["path"]}')
+        self.stdout.write(
+            'connections  req/s     p50 ms   p95 ms   p99 ms   errors  429s'
+        )
+        for n in options['connections']:
+            r = loadtest.run_scanners(
+                options['url'],
+                options['path'],
+                cards,
+                n,
+                options['duration'],
+            )
+            self.stdout.write(
+                f'{n:<12} {r["throughput"]:<9} {r["p50_ms"]!s:<8} '
+                f'{r["p95_ms"]!s:<8} {r["p99_ms"]!s:<8} {r["errors"]:<7} '
+                f'{r["rate_limited"]}'
+            )
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from webui.models import Presence
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the presence table from the Log table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Only compare the presence table with the logs, do not write.',
+        )
+
+    def handle(self, *args, check=False, **options):
+        if not check:
+            n = Presence.objects.rebuild()
+            self.stdout.write(self.style.SUCCESS(f'Rebuilt {n} presence rows.'))
+            return
+
+        problems = Presence.objects.inconsistencies()
+        for person_id, stored, expected in problems:
+            self.stdout.write(
+                f'person {person_id}: stored {stored and stored.snapshot()}, '
+                f'expected {expected and expected.snapshot()}'
+            )
+        if problems:
+            raise CommandError(f'{len(problems)} inconsistent presence rows.')
+        self.stdout.write(self.style.SUCCESS('Presence table is consistent.'))
@@ -0,0 +1,42 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from webui.models import Statistics
+
+
+class Command(BaseCommand):
+    help = """
+    Compute day/week/month/average/total statistics for all users, in one
+    query over sessions for all the days and one grouped query for the
+    averages and totals. Safe to run every few minutes, e.g. from
+    cron: `django rollup_statistics`.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--since',
+            type=date.fromisoformat,
+            help='First day to compute (YYYY-MM-DD). Defaults to today.',
+        )
+        parser.add_argument(
+            '--until',
+            type=date.fromisoformat,
+            help='Last day to compute (YYYY-MM-DD). Defaults to today.',
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, since=None, until=None, batch_size=1000, **options):
+        today = timezone.localdate()
+        until = until or today
+        since = since or until
+        started = timezone.now()
+        rows = Statistics.objects.rollup(since, until, batch_size=batch_size)
+        elapsed = (timezone.now() - started).total_seconds()
+        days = (until - since + timedelta(days=1)).days
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Rolled up {len(rows)} statistics over {days} days in {elapsed:.2f}s.'
+            )
+        )
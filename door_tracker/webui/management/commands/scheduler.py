@@ -0,0 +1,56 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from webui import scheduler
+
+
+class Command(BaseCommand):
+    help = """
+    Run the periodic jobs (statistics rollup, auto-checkout, cache warmup,
+    log archival) whenever they are due, forever. Several workers can run
+    side by side: each job runs on one of them at a time.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Run the due jobs once and exit.',
+        )
+        parser.add_argument(
+            '--run',
+            action='append',
+            choices=sorted(scheduler.TASKS),
+            metavar='NAME',
+            help='Run this job now, due or not, and exit. Can be repeated.',
+        )
+
+    def handle(self, *args, once=False, run=None, **options):
+        worker = scheduler.worker_name()
+        if run:
+            runs = scheduler.run_due(worker, names=run, force=True)
+            for name in set(run) - {finished.task_id for finished in runs}:
+                self.stderr.write(f'{name} is running on another worker.')
+            self.report(runs, fail=True)
+            return
+        tick = getattr(settings, 'SCHEDULER_TICK', 10)
+        while True:
+            self.report(scheduler.run_due(worker), fail=once)
+            if once:
+                return
+            time.sleep(tick)
+
+    def report(self, runs, fail=False):
+        failed = []
+        for finished in runs:
+            seconds = finished.duration.total_seconds()
+            if finished.succeeded:
+                message = f'{finished.task_id}: {finished.result} ({seconds:.2f}s)'
+                self.stdout.write(self.style.SUCCESS(message))
+            else:
+                self.stderr.write(f'{finished.task_id} failed ({seconds:.2f}s)')
+                failed.append(finished.task_id)
+        if failed and fail:
+            raise CommandError(f'Failed: {", ".join(failed)}')
@@ -0,0 +1,245 @@
+"""
+Prometheus metrics without a Prometheus client library.
+
+Counters and histograms live in process memory. When METRICS_DIR is set,
+every process also writes a snapshot of its metrics to a file in that
+directory (at most once per METRICS_FLUSH_INTERVAL seconds), and the
+/metrics endpoint adds up the snapshots of all worker processes. Without
+it, /metrics only shows the process that serves the request. Snapshots
+of processes that are gone, or that haven't been written for
+METRICS_STALE_AFTER seconds (a day by default), are deleted.
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+
+REGISTRY = []
+
+lock = threading.Lock()
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=(), collect=None):
+        """
+        collect, if given, is called when taking a snapshot and returns the
+        current values as a dict of label value tuples to numbers, for
+        counts that are kept elsewhere.
+        """
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self.values = defaultdict(float)
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with lock:
+            self.values[key] += amount
+        store.changed()
+
+    def samples(self):
+        values = self.collect() if self.collect else self.values
+        return [[list(key), value] for key, value in values.items()]
+
+
+class Histogram:
+    type = 'histogram'
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # per label values: [count per bucket (the last one is +Inf), sum]
+        self.values = {}
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with lock:
+            counts, _ = self.values.setdefault(key, [[0] * (len(self.buckets) + 1), 0])
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[key][1] += value
+        store.changed()
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        return [
+            [list(key), list(counts), total]
+            for key, (counts, total) in self.values.items()
+        ]
+
+
+def snapshot():
+    with lock:
+        return {
+            metric.name: {
+                'type': metric.type,
+                'help': metric.help,
+                'labelnames': metric.labelnames,
+                'buckets': getattr(metric, 'buckets', None),
+                'samples': metric.samples(),
+            }
+            for metric in REGISTRY
+        }
+
+
+def merge(snapshots):
+    """Adds up the samples of snapshots taken by several processes."""
+    merged = {}
+    for snap in snapshots:
+        for name, metric in snap.items():
+            target = merged.setdefault(name, {**metric, 'samples': {}})
+            samples = target['samples']
+            for key, *values in metric['samples']:
+                key = tuple(key)
+                if key not in samples:
+                    samples[key] = values
+                elif metric['type'] == 'counter':
+                    samples[key][0] += values[0]
+                else:
+                    counts, total = samples[key]
+                    samples[key] = [
+                        [a + b for a, b in zip(counts, values[0], strict=True)],
+                        total + values[1],
+                    ]
+    return merged
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"')
+
+
+def format_labels(names, values, **extra):
+    pairs = [*zip(names, values, strict=True), *extra.items()]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+
+def exposition():
+    """All metrics, from all processes, in the Prometheus text format."""
+    lines = []
+    for name, metric in sorted(merge([snapshot(), *store.others()]).items()):
+        lines.append(f'# HELP {name} {metric["help"]}')
+        lines.append(f'# TYPE {name} {metric["type"]}')
+        names = metric['labelnames']
+        for key, values in sorted(metric['samples'].items()):
+            if metric['type'] == 'counter':
+                lines.append(f'{name}{format_labels(names, key)} {values[0]}')
+                continue
+            counts, total = values
+            cumulative = 0
+            for le, count in zip([*metric['buckets'], '+Inf'], counts, strict=True):
+                cumulative += count
+                labels = format_labels(names, key, le=le)
+                lines.append(f'{name}_bucket{labels} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(names, key)} {total}')
+            lines.append(f'{name}_count{format_labels(names, key)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+class FileStore:
+    """Snapshots of every worker process, one JSON file per process."""
+
+    def __init__(self, directory, interval, stale_after):
+        self.directory = Path(directory) if directory else None
+        self.interval = interval
+        self.stale_after = stale_after
+        self.last_flush = 0
+
+    @property
+    def path(self):
+        return self.directory / f'{os.getpid()}.json'
+
+    def changed(self):
+        if self.directory and time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if not self.directory:
+            return
+        self.last_flush = time.monotonic()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(f'.{threading.get_ident()}.tmp')
+        tmp.write_text(json.dumps(snapshot()))
+        os.replace(tmp, self.path)
+
+    def others(self):
+        """Snapshots written by the other processes."""
+        if not self.directory or not self.directory.exists():
+            return []
+        snapshots = []
+        for path in self.directory.glob('*.json'):
+            if path == self.path:
+                continue
+            try:
+                if self.is_stale(path):
+                    path.unlink(missing_ok=True)
+                    continue
+                snapshots.append(json.loads(path.read_text()))
+            except (OSError, ValueError):
+                continue  # being replaced right now
+        return snapshots
+
+    def is_stale(self, path):
+        if time.time() - path.stat().st_mtime > self.stale_after:
+            return True
+        try:
+            os.kill(int(path.stem), 0)
+        except ProcessLookupError:
+            return True
+        except (PermissionError, ValueError):
+            pass  # someone else's process, or not a pid
+        return False
+
+
+store = FileStore(
+    getattr(settings, 'METRICS_DIR', None),
+    getattr(settings, 'METRICS_FLUSH_INTERVAL', 1),
+    getattr(settings, 'METRICS_STALE_AFTER', 24 * 60 * 60),
+)
+atexit.register(store.flush)
+
+
+SCANS = Counter(
+    'door_scans_total',
+    'Scans received, by scanner name and outcome.',
+    ['scanner', 'outcome'],
+)
+SCAN_DURATION = Histogram(
+    'door_scan_duration_seconds',
+    'Time to handle a scan, by outcome.',
+    ['outcome'],
+)
+REQUEST_DB_DURATION = Histogram(
+    'door_request_db_duration_seconds',
+    'Time spent in database queries per request, by view.',
+    ['view'],
+)
+ROLLUP_DURATION = Histogram(
+    'door_statistics_rollup_duration_seconds',
+    'Time to roll up statistics.',
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300),
+)
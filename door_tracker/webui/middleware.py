@@ -0,0 +1,110 @@
+import logging
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# stats of the request being served; a context variable so that queries run
+# by sync_to_async in another thread are still counted for their request
+current_stats = ContextVar('current_stats', default=None)
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+        self.slowest = 0
+        self.slowest_sql = None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.count += 1
+            self.duration += duration
+            if duration >= self.slowest:
+                self.slowest = duration
+                self.slowest_sql = sql
+
+
+def record_query(execute, sql, params, many, context):
+    stats = current_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    return stats(execute, sql, params, many, context)
+
+
+@receiver(connection_created)
+def instrument_connection(connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class QueryInstrumentationMiddleware:
+    """
+    Counts the database queries of every request, and reports their number,
+    total time and the slowest one in a Server-Timing header and a log line.
+    Queries run while a streaming response is consumed are not counted.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats = QueryStats()
+        token = current_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current_stats.reset(token)
+        return self.report(request, response, stats, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        stats = QueryStats()
+        token = current_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_stats.reset(token)
+        return self.report(request, response, stats, time.perf_counter() - start)
+
+    def report(self, request, response, stats, duration):
+        match = request.resolver_match
+        metrics.REQUEST_DB_DURATION.observe(
+            stats.duration, view=match.url_name if match else ''
+        )
+        response['Server-Timing'] = ', '.join(
+            [
+                f'db;dur={stats.duration * 1000:.1f};desc="{stats.count} queries"',
+                f'db-slowest;dur={stats.slowest * 1000:.1f}',
+                f'total;dur={duration * 1000:.1f}',
+            ]
+        )
+        logger.info(
+            '%s %s %s: %d queries in %.1f ms, slowest %.1f ms: %s',
+            request.method,
+            request.path,
+            response.status_code,
+            stats.count,
+            stats.duration * 1000,
+            stats.slowest * 1000,
+            stats.slowest_sql,
+        )
+        return response
@@ -0,0 +1,93 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:13
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def populate_presence(apps, schema_editor):
+    Log = apps.get_model('webui', 'Log')
+    Presence = apps.get_model('webui', 'Presence')
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    latest = (
+        Log.objects.filter(tag__owner=models.OuterRef('pk'))
+        .order_by('-time', '-id')
+        .values('pk')[:1]
+    )
+    ids = (
+        User.objects.annotate(last_log_id=models.Subquery(latest))
+        .exclude(last_log_id=None)
+        .values_list('last_log_id', flat=True)
+    )
+    Presence.objects.bulk_create(
+        [
+            Presence(
+                person_id=log.tag.owner_id,
+                state=log.type,
+                last_log=log,
+                since=log.time,
+                scanner_id=log.scanner_id,
+            )
+            for log in Log.objects.select_related('tag').filter(pk__in=ids)
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('webui', '0012_alter_log_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Presence',
+            fields=[
+                (
+                    'person',
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name='presence',
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                (
+                    'state',
+                    models.CharField(
+                        choices=[
+                            ('IN', 'Check-in'),
+                            ('OUT', 'Check-out'),
+                            ('WTF', 'Card not linked'),
+                            ('REG', 'Card registered'),
+                        ],
+                        max_length=3,
+                    ),
+                ),
+                ('since', models.DateTimeField()),
+                (
+                    'last_log',
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name='+',
+                        to='webui.log',
+                    ),
+                ),
+                (
+                    'scanner',
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name='+',
+                        to='webui.scanner',
+                    ),
+                ),
+            ],
+        ),
+        migrations.RunPython(populate_presence, migrations.RunPython.noop),
+    ]
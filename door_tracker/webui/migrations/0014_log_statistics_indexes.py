@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:13
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('webui', '0013_presence'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='log',
+            index=models.Index(fields=['tag', 'time'], name='log_tag_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='log',
+            index=models.Index(fields=['time'], name='log_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='statistics',
+            index=models.Index(
+                fields=['person', 'date'], name='statistics_person_date_idx'
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='tag',
+            index=models.Index(fields=['tag'], name='tag_tag_idx'),
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:15
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def populate_sessions(apps, schema_editor):
+    """Pair the check-ins and check-outs of the logs into sessions."""
+    Log = apps.get_model('webui', 'Log')
+    Session = apps.get_model('webui', 'Session')
+    logs = (
+        Log.objects.filter(type__in=['IN', 'OUT'], tag__owner__isnull=False)
+        .order_by('tag__owner', 'time', 'id')
+        .values_list('tag__owner', 'type', 'time')
+        .iterator(chunk_size=1000)
+    )
+    open_sessions = {}
+    batch = []
+    for owner_id, type, time in logs:
+        session = open_sessions.get(owner_id)
+        if type == 'IN':
+            if session is not None:
+                # a check-in while checked in restarts the session
+                session.start = time
+            else:
+                open_sessions[owner_id] = Session(person_id=owner_id, start=time)
+        elif session is not None:
+            session.end = time
+            session.duration = time - session.start
+            batch.append(open_sessions.pop(owner_id))
+            if len(batch) >= 1000:
+                Session.objects.bulk_create(batch)
+                batch = []
+    Session.objects.bulk_create(batch + list(open_sessions.values()), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('webui', '0014_log_statistics_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Session',
+            fields=[
+                (
+                    'id',
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='ID',
+                    ),
+                ),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField(blank=True, null=True)),
+                ('duration', models.DurationField(blank=True, null=True)),
+                (
+                    'person',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='sessions',
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                'indexes': [
+                    models.Index(
+                        fields=['person', 'start'], name='session_person_start_idx'
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(populate_sessions, migrations.RunPython.noop),
+    ]
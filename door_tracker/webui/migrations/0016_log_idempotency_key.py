@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('webui', '0015_session'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='log',
+            name='idempotency_key',
+            field=models.CharField(blank=True, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:40
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def populate_day(apps, schema_editor):
+    Statistics = apps.get_model('webui', 'Statistics')
+    seen = set()
+    duplicates = []
+    # newest first, so the last computed row of each day is kept
+    for stats in Statistics.objects.order_by('-date', '-id').iterator():
+        stats.day = timezone.localtime(stats.date).date()
+        if (stats.person_id, stats.day) in seen:
+            duplicates.append(stats.pk)
+            continue
+        seen.add((stats.person_id, stats.day))
+        stats.save(update_fields=['day'])
+    Statistics.objects.filter(pk__in=duplicates).delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('webui', '0016_log_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='statistics',
+            name='day',
+            field=models.DateField(null=True),
+        ),
+        migrations.RunPython(populate_day, migrations.RunPython.noop),
+    ]
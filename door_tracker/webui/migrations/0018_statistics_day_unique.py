@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('webui', '0017_statistics_day'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='statistics',
+            name='day',
+            field=models.DateField(),
+        ),
+        migrations.AddConstraint(
+            model_name='statistics',
+            constraint=models.UniqueConstraint(
+                fields=('person', 'day'), name='statistics_person_day_unique'
+            ),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:29
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def populate_valid_until(apps, schema_editor):
+    Membership = apps.get_model('webui', 'Membership')
+    previous = None
+    changed = []
+    for membership in Membership.objects.order_by('person', 'starting_from', 'pk'):
+        if previous is not None and previous.person_id == membership.person_id:
+            previous.valid_until = membership.starting_from
+            changed.append(previous)
+        previous = membership
+    Membership.objects.bulk_update(changed, ['valid_until'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('webui', '0018_statistics_day_unique'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='membership',
+            name='valid_until',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(populate_valid_until, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='membership',
+            index=models.Index(
+                fields=['person', 'starting_from'], name='membership_person_start_idx'
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='membership',
+            index=models.Index(
+                fields=['subteam', 'valid_until'], name='membership_subteam_until_idx'
+            ),
+        ),
+    ]
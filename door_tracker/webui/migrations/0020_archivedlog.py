@@ -0,0 +1,62 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:49
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('webui', '0019_membership_valid_until'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedLog',
+            fields=[
+                (
+                    'type',
+                    models.CharField(
+                        choices=[
+                            ('IN', 'Check-in'),
+                            ('OUT', 'Check-out'),
+                            ('WTF', 'Card not linked'),
+                            ('REG', 'Card registered'),
+                        ],
+                        max_length=3,
+                    ),
+                ),
+                ('time', models.DateTimeField(default=django.utils.timezone.now)),
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('idempotency_key', models.CharField(blank=True, null=True)),
+                (
+                    'scanner',
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='+',
+                        to='webui.scanner',
+                    ),
+                ),
+                (
+                    'tag',
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='+',
+                        to='webui.tag',
+                    ),
+                ),
+            ],
+            options={
+                'indexes': [
+                    models.Index(
+                        fields=['tag', 'time'], name='archivedlog_tag_time_idx'
+                    ),
+                    models.Index(fields=['time'], name='archivedlog_time_idx'),
+                ],
+            },
+        ),
+    ]
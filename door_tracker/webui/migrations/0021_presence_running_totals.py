@@ -0,0 +1,60 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:06
+
+import datetime
+
+from django.db import migrations, models
+from django.utils import timezone
+
+from webui import utils
+
+
+def populate_totals(apps, schema_editor):
+    Presence = apps.get_model('webui', 'Presence')
+    Session = apps.get_model('webui', 'Session')
+    today = timezone.localdate()
+    day_start, day_end = utils.day_range(today, today)
+    week_start = utils.start_of_day(utils.week_start(today))
+    presences = Presence.objects.in_bulk()
+    sessions = Session.objects.filter(
+        person__in=presences, start__lt=day_end, end__gt=week_start
+    )
+    for session in sessions.iterator():
+        presence = presences[session.person_id]
+        presence.worked_day += utils.overlap(
+            session.start, session.end, day_start, day_end
+        )
+        presence.worked_week += utils.overlap(
+            session.start, session.end, week_start, day_end
+        )
+    for presence in presences.values():
+        presence.counted_on = today
+    Presence.objects.bulk_update(
+        presences.values(),
+        ['counted_on', 'worked_day', 'worked_week'],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('webui', '0020_archivedlog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='presence',
+            name='counted_on',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='presence',
+            name='worked_day',
+            field=models.DurationField(default=datetime.timedelta),
+        ),
+        migrations.AddField(
+            model_name='presence',
+            name='worked_week',
+            field=models.DurationField(default=datetime.timedelta),
+        ),
+        migrations.RunPython(populate_totals, migrations.RunPython.noop),
+    ]
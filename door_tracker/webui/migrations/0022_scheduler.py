@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:10
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('webui', '0021_presence_running_totals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledTask',
+            fields=[
+                ('name', models.CharField(primary_key=True, serialize=False)),
+                ('next_run', models.DateTimeField(default=django.utils.timezone.now)),
+                ('leased_by', models.CharField(blank=True)),
+                ('leased_until', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TaskRun',
+            fields=[
+                (
+                    'id',
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='ID',
+                    ),
+                ),
+                ('worker', models.CharField()),
+                ('started', models.DateTimeField()),
+                ('duration', models.DurationField()),
+                ('succeeded', models.BooleanField()),
+                ('result', models.TextField(blank=True)),
+                (
+                    'task',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='runs',
+                        to='webui.scheduledtask',
+                    ),
+                ),
+            ],
+            options={
+                'indexes': [
+                    models.Index(
+                        fields=['task', 'started'], name='taskrun_task_started_idx'
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('webui', '0022_scheduler'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scanner',
+            name='scan_burst',
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text='Scans allowed in a burst before the rate applies. Leave empty for the SCAN_RATE_LIMIT setting.',
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name='scanner',
+            name='scans_per_minute',
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text='Sustained scans a minute; 0 for no limit. Leave empty for the SCAN_RATE_LIMIT setting.',
+                null=True,
+            ),
+        ),
+    ]
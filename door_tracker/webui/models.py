@@ -1,13 +1,26 @@
+import heapq
+from datetime import timedelta
 from enum import Enum
+from functools import partial
+from itertools import groupby
+from operator import attrgetter
 
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models import OuterRef, Subquery
-from django.db.models.aggregates import Max
+from django.db import models, transaction
+from django.db.models import F, OuterRef, Q, Subquery, Value
+from django.db.models.aggregates import Avg, Sum
+from django.db.models.functions import Coalesce, Greatest, Least
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 
+from . import events, metrics, utils, worktime
+
+
+class AbstractLog(models.Model):
+    """The fields and behaviour shared by Log and ArchivedLog."""
 
-class Log(models.Model):
     class LogEntryType(models.TextChoices):
         CHECKIN = 'IN', 'Check-in'
         CHECKOUT = 'OUT', 'Check-out'
@@ -15,6 +28,23 @@ class Log(models.Model):
         REGISTRATION = 'REG', 'Card registered'
 
     type = models.CharField(max_length=3, choices=LogEntryType.choices)
+    time = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        abstract = True
+
+    def person(self):
+        if not self.tag:
+            return 'WebUI'
+        if self.tag.get_state() != TagState.UNAUTHORIZED:
+            return f'{self.tag.owner.get_full_name()} ({self.tag.name})'
+        return None
+
+    def __str__(self):
+        return ' | '.join([str(self.time), self.type, self.person() or '-'])
+
+
+class Log(AbstractLog):
     scanner = models.ForeignKey(
         'Scanner',
         blank=True,
@@ -29,17 +59,81 @@ class Log(models.Model):
         on_delete=models.CASCADE,
         related_name='logs',
     )
-    time = models.DateTimeField(default=timezone.now)
+    # set by scanners uploading buffered scans, to make uploads replayable
+    idempotency_key = models.CharField(blank=True, null=True, unique=True)
 
-    def person(self):
-        if not self.tag:
-            return 'WebUI'
-        if self.tag.get_state() != TagState.UNAUTHORIZED:
-            return f'{self.tag.owner.get_full_name()} ({self.tag.name})'
-        return None
+    class Meta:
+        indexes = [
+            models.Index(fields=['tag', 'time'], name='log_tag_time_idx'),
+            models.Index(fields=['time'], name='log_time_idx'),
+        ]
 
-    def __str__(self):
-        return ' | '.join([str(self.time), self.type, self.person() or '-'])
+
+class ArchivedLog(AbstractLog):
+    """
+    Logs older than the retention horizon, moved out of the Log table by
+    the archive_logs command so that the live table only holds recent
+    history. Rows keep the id they had in Log, so ids are unique across
+    both tables and (time, id) orders them together.
+
+    Nothing is aggregated from logs directly: Session rows are kept and
+    Statistics are rolled up from those, so archiving doesn't change any
+    totals.
+    """
+
+    id = models.BigIntegerField(primary_key=True)
+    scanner = models.ForeignKey(
+        'Scanner',
+        blank=True,
+        null=True,
+        on_delete=models.CASCADE,
+        related_name='+',
+    )
+    tag = models.ForeignKey(
+        'Tag',
+        blank=True,
+        null=True,
+        on_delete=models.CASCADE,
+        related_name='+',
+    )
+    idempotency_key = models.CharField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['tag', 'time'], name='archivedlog_tag_time_idx'),
+            models.Index(fields=['time'], name='archivedlog_time_idx'),
+        ]
+
+    class ArchivedLogManager(models.Manager):
+        def horizon(self):
+            """Midnight LOG_RETENTION_DAYS (365 by default) days ago."""
+            days = getattr(settings, 'LOG_RETENTION_DAYS', 365)
+            return utils.start_of_day(timezone.localdate() - timedelta(days=days))
+
+        def archive(self, before, batch_size=1000):
+            """
+            Move the logs older than before from Log to this table, in one
+            transaction per batch. The latest log of every person stays in
+            Log, because their Presence points to it.
+            """
+            current = Presence.objects.exclude(last_log=None).values('last_log')
+            logs = (
+                Log.objects.filter(time__lt=before)
+                .exclude(pk__in=current)
+                .order_by('pk')
+            )
+            fields = [f.attname for f in self.model._meta.concrete_fields]
+            n = 0
+            while True:
+                with transaction.atomic():
+                    batch = list(logs.values(*fields)[:batch_size])
+                    if not batch:
+                        return n
+                    self.bulk_create([self.model(**row) for row in batch])
+                    Log.objects.filter(pk__in=[row['id'] for row in batch]).delete()
+                n += len(batch)
+
+    objects = ArchivedLogManager()
 
 
 class Membership(models.Model):
@@ -55,21 +149,81 @@ class Membership(models.Model):
     )
     job = models.ForeignKey('Job', blank=True, null=True, on_delete=models.CASCADE)
     starting_from = models.DateTimeField(default=timezone.now)
+    # starting_from of the person's next membership, None for the latest one;
+    # kept up to date by save() and the post_delete receiver below
+    valid_until = models.DateTimeField(blank=True, null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['person', 'starting_from'],
+                name='membership_person_start_idx',
+            ),
+            models.Index(
+                fields=['subteam', 'valid_until'],
+                name='membership_subteam_until_idx',
+            ),
+        ]
 
     class MembershipManager(models.Manager):
         def filter_effective(self):
-            qs = self.all()
-            return qs.filter(
-                starting_from=Subquery(
-                    qs.filter(person=OuterRef('person'))
-                    .values('person')
-                    .annotate(starting_from=Max('starting_from'))
-                    .values('starting_from')
-                ),
+            """The latest membership of every person."""
+            return self.filter(valid_until=None)
+
+        def effective_at(self, time):
+            """The membership of every person that was in effect at time."""
+            return self.filter(
+                Q(valid_until__gt=time) | Q(valid_until=None),
+                starting_from__lte=time,
+            )
+
+        def filter_logs(self, logs, subteam):
+            """
+            The logs made by people while they were members of subteam. The
+            intervals of a person don't overlap, so this is a plain join.
+            """
+            return logs.filter(
+                Q(tag__owner__memberships__valid_until__gt=F('time'))
+                | Q(tag__owner__memberships__valid_until=None),
+                tag__owner__memberships__subteam=subteam,
+                tag__owner__memberships__starting_from__lte=F('time'),
             )
 
+        def update_intervals(self, people):
+            """Recompute valid_until of all memberships of people."""
+            memberships = self.filter(person__in=people).order_by(
+                'person', 'starting_from', 'pk'
+            )
+            changed = []
+            for _, group in groupby(memberships, key=attrgetter('person_id')):
+                group = list(group)
+                for membership, following in zip(group, [*group[1:], None]):
+                    valid_until = following and following.starting_from
+                    if membership.valid_until != valid_until:
+                        membership.valid_until = valid_until
+                        changed.append(membership)
+            self.bulk_update(changed, ['valid_until'])
+
     objects = MembershipManager()
 
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            people = {self.person_id}
+            if self.pk is not None:
+                # the membership may move from another person
+                people.update(
+                    Membership.objects.filter(pk=self.pk).values_list(
+                        'person', flat=True
+                    )
+                )
+            super().save(*args, **kwargs)
+            Membership.objects.update_intervals(people)
+
+
+@receiver(post_delete, sender=Membership)
+def update_membership_intervals(instance, **kwargs):
+    Membership.objects.update_intervals([instance.person_id])
+
 
 class TagState(Enum):
     CLAIMED = 'claimed'
@@ -88,6 +242,11 @@ class Tag(models.Model):
         related_name='tags',
     )
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['tag'], name='tag_tag_idx'),
+        ]
+
     def owner_name(self):
         if not self.owner:
             return None
@@ -153,6 +312,9 @@ class Statistics(models.Model):
     person = models.ForeignKey(
         User, on_delete=models.CASCADE, related_name='statistics'
     )
+    # the day these statistics are about
+    day = models.DateField()
+    # when they were last computed
     date = models.DateTimeField(auto_now_add=True)
     minutes_day = models.IntegerField()
     minutes_week = models.IntegerField()
@@ -160,16 +322,620 @@ class Statistics(models.Model):
     average_week = models.IntegerField()
     total_minutes = models.IntegerField()
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['person', 'day'], name='statistics_person_day_unique'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['person', 'date'], name='statistics_person_date_idx'),
+        ]
+
+    class StatisticsManager(models.Manager):
+        def origin(self, first):
+            """The start of the week or of the month of first, the earlier."""
+            return min(first - timedelta(days=first.weekday()), first.replace(day=1))
+
+        def sessions(self, first, last, people=None):
+            """The sessions the statistics of days first..last are made of."""
+            sessions = Session.objects.overlapping(
+                *utils.day_range(self.origin(first), last)
+            )
+            if people is not None:
+                sessions = sessions.filter(person__in=people)
+            return sessions
+
+        def compute(self, first, last=None, people=None):
+            """
+            Unsaved statistics of days first..last for everyone who worked
+            that week or month (or only for the users in people), without
+            averages and totals.
+
+            One query reads the sessions from the start of the first week or
+            month on, split into days by worktime; the week and month to
+            date are differences of running totals.
+            """
+            last = last or first
+            now = timezone.now()
+            origin = self.origin(first)
+            sessions = self.sessions(first, last, people)
+            worked = worktime.cumulative_by_day(
+                sessions.values_list('person', 'start', 'end').iterator(),
+                origin,
+                last,
+                now,
+            )
+            # asked for explicitly, so they get a row even if it's empty
+            wanted = {person.pk for person in people or ()}
+            for person_id in wanted:
+                worked.setdefault(person_id, [0] * ((last - origin).days + 2))
+
+            rows = {}
+            day = first
+            while day <= last:
+                i = (day - origin).days
+                week = (day - timedelta(days=day.weekday()) - origin).days
+                month = (day.replace(day=1) - origin).days
+                for person_id, totals in worked.items():
+                    worked_week = totals[i + 1] - totals[week]
+                    worked_month = totals[i + 1] - totals[month]
+                    if not (worked_week or worked_month) and person_id not in wanted:
+                        continue
+                    rows[person_id, day] = self.model(
+                        person_id=person_id,
+                        day=day,
+                        date=now,
+                        minutes_day=to_minutes(microseconds(totals[i + 1] - totals[i])),
+                        minutes_week=to_minutes(microseconds(worked_week)),
+                        minutes_month=to_minutes(microseconds(worked_month)),
+                        average_week=0,
+                        total_minutes=0,
+                    )
+                day += timedelta(days=1)
+            return rows
+
+        @metrics.ROLLUP_DURATION.time()
+        def rollup(self, first, last=None, people=None, batch_size=1000):
+            """
+            Compute the statistics of days first..last for everyone who worked
+            that week or month (or only for the users in people), and upsert
+            them.
+
+            The days cost one query over sessions; averages and totals are one
+            more grouped query at the end.
+            """
+            rows = self.compute(first, last, people)
+
+            fields = ['date', 'minutes_day', 'minutes_week', 'minutes_month']
+            with transaction.atomic():
+                self.upsert(rows.values(), fields, batch_size)
+                # only the people of this run: the rest didn't change. Those
+                # who worked are a subquery, since there can be more of them
+                # than SQLite takes parameters
+                if people is None:
+                    people = self.sessions(first, last or first).values('person')
+                stats = self.filter(person__in=people)
+                totals = (
+                    stats.values('person')
+                    .order_by()
+                    .annotate(
+                        average_week=Avg('minutes_week'),
+                        total_minutes=Sum('minutes_day'),
+                    )
+                    .values_list('person', 'average_week', 'total_minutes')
+                )
+                totals = {p: (int(avg or 0), total or 0) for p, avg, total in totals}
+                for (person_id, _), row in rows.items():
+                    row.average_week, row.total_minutes = totals[person_id]
+                self.upsert(
+                    rows.values(), ['average_week', 'total_minutes'], batch_size
+                )
+            return list(rows.values())
+
+        def upsert(self, rows, fields, batch_size):
+            return self.bulk_create(
+                rows,
+                batch_size=batch_size,
+                update_conflicts=True,
+                unique_fields=['person', 'day'],
+                update_fields=fields,
+            )
+
+    objects = StatisticsManager()
+
 
 class Scanner(models.Model):
     id = models.CharField(primary_key=True)
     name = models.CharField()
+    scans_per_minute = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        help_text='Sustained scans a minute; 0 for no limit. '
+        'Leave empty for the SCAN_RATE_LIMIT setting.',
+    )
+    scan_burst = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        help_text='Scans allowed in a burst before the rate applies. '
+        'Leave empty for the SCAN_RATE_LIMIT setting.',
+    )
+
+    def __str__(self):
+        return self.name
+
+
+class Presence(models.Model):
+    """
+    Denormalized copy of the latest log of every person.
+
+    Kept up to date by save_log(), so that the current state of a person is
+    a primary key lookup instead of a sort over their whole history.
+    """
+
+    person = models.OneToOneField(
+        User,
+        primary_key=True,
+        on_delete=models.CASCADE,
+        related_name='presence',
+    )
+    state = models.CharField(max_length=3, choices=Log.LogEntryType.choices)
+    last_log = models.ForeignKey(
+        Log,
+        blank=True,
+        null=True,
+        on_delete=models.SET_NULL,
+        related_name='+',
+    )
+    since = models.DateTimeField()
+    scanner = models.ForeignKey(
+        Scanner,
+        blank=True,
+        null=True,
+        on_delete=models.SET_NULL,
+        related_name='+',
+    )
+    # running totals of the closed sessions of counted_on and of its week,
+    # advanced as sessions close and reset by the first write on a later day
+    counted_on = models.DateField(blank=True, null=True)
+    worked_day = models.DurationField(default=timedelta)
+    worked_week = models.DurationField(default=timedelta)
+
+    class PresenceManager(models.Manager):
+        def record(self, *logs, sessions=()):
+            """
+            Advance the presence of the owners of these logs, and add the
+            sessions that they closed to the running totals. The owners
+            loaded with the logs get their new presence cached, so reading
+            log.tag.owner.presence afterwards costs no query.
+            """
+            latest = {}
+            for log in sorted(logs, key=log_order):
+                if log.tag and log.tag.owner_id is not None:
+                    latest[log.tag.owner_id] = log
+            closed = {}
+            for session in sessions:
+                if session.end is not None:
+                    closed.setdefault(session.person_id, []).append(session)
+            if not latest and not closed:
+                return []
+            current = self.select_for_update().in_bulk(latest.keys() | closed.keys())
+            today = timezone.localdate()
+            presences = []
+            for owner_id in latest.keys() | closed.keys():
+                presence = current.get(owner_id)
+                log = latest.get(owner_id)
+                if log and not (presence and presence.order() > log_order(log)):
+                    old = presence
+                    presence = self.model(
+                        person_id=owner_id,
+                        state=log.type,
+                        last_log=log,
+                        since=log.time,
+                        scanner_id=log.scanner_id,
+                    )
+                    if old:
+                        presence.counted_on = old.counted_on
+                        presence.worked_day = old.worked_day
+                        presence.worked_week = old.worked_week
+                elif presence is None or owner_id not in closed:
+                    # an older log arrived late, it doesn't change the current state
+                    continue
+                presence.count(closed.get(owner_id, ()), today)
+                presences.append(presence)
+                if log and Tag.owner.is_cached(log.tag):
+                    log.tag.owner.presence = presence
+            return self.bulk_create(
+                presences,
+                update_conflicts=True,
+                unique_fields=['person'],
+                update_fields=[
+                    'state',
+                    'last_log',
+                    'since',
+                    'scanner',
+                    'counted_on',
+                    'worked_day',
+                    'worked_week',
+                ],
+            )
+
+        def from_logs(self, people=None):
+            """Unsaved presences of everyone, or only people, from the Log table."""
+            latest = (
+                Log.objects.filter(tag__owner=OuterRef('pk'))
+                .order_by('-time', '-id')
+                .values('pk')[:1]
+            )
+            users = User.objects.all()
+            if people is not None:
+                users = users.filter(pk__in=people)
+            ids = (
+                users.annotate(last_log_id=Subquery(latest))
+                .exclude(last_log_id=None)
+                .values_list('last_log_id', flat=True)
+            )
+            logs = Log.objects.select_related('tag').filter(pk__in=ids)
+            presences = [
+                self.model(
+                    person_id=log.tag.owner_id,
+                    state=log.type,
+                    last_log=log,
+                    since=log.time,
+                    scanner_id=log.scanner_id,
+                )
+                for log in logs
+            ]
+            today = timezone.localdate()
+            start, end = utils.day_range(utils.week_start(today), today)
+            sessions = Session.objects.filter(
+                person__in=[p.person_id for p in presences],
+                start__lt=end,
+                end__gt=start,
+            )
+            closed = {}
+            for session in sessions:
+                closed.setdefault(session.person_id, []).append(session)
+            for presence in presences:
+                presence.count(closed.get(presence.person_id, ()), today)
+            return presences
+
+        def rebuild(self, people=None):
+            presences = self.from_logs(people)
+            stored = self.all()
+            if people is not None:
+                stored = stored.filter(person__in=people)
+            with transaction.atomic():
+                stored.delete()
+                self.bulk_create(presences, batch_size=1000)
+            return len(presences)
+
+        def inconsistencies(self):
+            """
+            Compare the table with the Log table.
+
+            Returns a list of (person_id, stored, expected) tuples, where either
+            side can be None if the row is missing.
+            """
+            expected = {p.person_id: p for p in self.from_logs()}
+            stored = {p.person_id: p for p in self.all()}
+            problems = []
+            for person_id in sorted(expected.keys() | stored.keys()):
+                e = expected.get(person_id)
+                s = stored.get(person_id)
+                if (e and e.snapshot()) != (s and s.snapshot()):
+                    problems.append((person_id, s, e))
+            return problems
+
+    objects = PresenceManager()
+
+    def snapshot(self):
+        return (self.state, self.last_log_id, self.since, self.scanner_id)
+
+    def reset(self, today):
+        """Start today's total, and this week's if today is in a new week."""
+        if self.counted_on == today:
+            return
+        if self.counted_on is None or utils.week_start(
+            self.counted_on
+        ) != utils.week_start(today):
+            self.worked_week = timedelta()
+        self.worked_day = timedelta()
+        self.counted_on = today
+
+    def count(self, sessions, today):
+        """Add the parts of closed sessions in today and this week."""
+        self.reset(today)
+        day_start, day_end = utils.day_range(today, today)
+        week_start = utils.start_of_day(utils.week_start(today))
+        for session in sessions:
+            self.worked_day += utils.overlap(
+                session.start, session.end, day_start, day_end
+            )
+            self.worked_week += utils.overlap(
+                session.start, session.end, week_start, day_end
+            )
+
+    def worked(self, today=None):
+        """(time worked today, time worked this week) in closed sessions."""
+        self.reset(today or timezone.localdate())
+        return self.worked_day, self.worked_week
+
+    def order(self):
+        return (self.since, self.last_log_id or 0)
+
+    def __str__(self):
+        return f'{self.person} | {self.state} since {self.since}'
+
+
+class Session(models.Model):
+    """
+    A check-in/check-out interval. Sessions are opened by a check-in and
+    closed by the next check-out; a session without an end is still open.
+    """
+
+    person = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sessions')
+    start = models.DateTimeField()
+    end = models.DateTimeField(blank=True, null=True)
+    duration = models.DurationField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['person', 'start'], name='session_person_start_idx'),
+        ]
+
+    class SessionManager(models.Manager):
+        def record(self, *logs):
+            """Open or close the sessions of the owners of these logs."""
+            owned = [log for log in logs if log.tag and log.tag.owner_id is not None]
+            events = [
+                (log.tag.owner_id, log.type, log.time)
+                for log in sorted(
+                    owned, key=lambda log: (log.tag.owner_id, log_order(log))
+                )
+            ]
+            if not events:
+                return []
+            open_sessions = {
+                s.person_id: s
+                for s in self.select_for_update()
+                .filter(person__in={owner_id for owner_id, _, _ in events}, end=None)
+                .order_by('start')
+            }
+            sessions = list(self.from_logs(events, open_sessions))
+            new = [s for s in sessions if s.pk is None]
+            changed = [s for s in sessions if s.pk is not None]
+            self.bulk_create(new)
+            self.bulk_update(changed, ['start', 'end', 'duration'])
+            return sessions
+
+        def from_logs(self, logs, open_sessions=None):
+            """
+            Pair check-ins and check-outs into sessions.
+
+            logs are (owner_id, type, time) tuples ordered by owner and time;
+            open_sessions maps owner ids to the sessions they have open. Yields
+            every session that was closed, followed by the ones left open.
+            """
+            if open_sessions is None:
+                open_sessions = {}
+            for owner_id, type, time in logs:
+                session = open_sessions.get(owner_id)
+                if session is not None and time < session.start:
+                    # a late log, older than the open session: rebuild()
+                    # puts it in place, here it would end before it starts
+                    continue
+                if type == Log.LogEntryType.CHECKIN:
+                    if session is not None:
+                        # a check-in while checked in restarts the session
+                        session.start = time
+                    else:
+                        open_sessions[owner_id] = self.model(
+                            person_id=owner_id, start=time
+                        )
+                elif type == Log.LogEntryType.CHECKOUT and session is not None:
+                    session.end = time
+                    session.duration = time - session.start
+                    del open_sessions[owner_id]
+                    yield session
+            yield from open_sessions.values()
+
+        def rebuild(self, batch_size=1000, people=None):
+            """Rebuild the sessions of everyone (or only people) from the logs."""
+            filters = {'tag__owner__isnull': False}
+            if people is not None:
+                filters = {'tag__owner__in': people}
+            # both tiers, merged in the order each one is read in
+            tiers = [
+                model.objects.filter(
+                    type__in=[Log.LogEntryType.CHECKIN, Log.LogEntryType.CHECKOUT],
+                    **filters,
+                )
+                .order_by('tag__owner', 'time', 'id')
+                .values_list('tag__owner', 'time', 'id', 'type')
+                .iterator(chunk_size=batch_size)
+                for model in (ArchivedLog, Log)
+            ]
+            logs = (
+                (owner_id, type, time)
+                for owner_id, time, _, type in heapq.merge(*tiers)
+            )
+            sessions = self.all()
+            if people is not None:
+                sessions = sessions.filter(person__in=people)
+            n = 0
+            with transaction.atomic():
+                sessions.delete()
+                batch = []
+                for session in self.from_logs(logs):
+                    batch.append(session)
+                    if len(batch) >= batch_size:
+                        n += len(self.bulk_create(batch))
+                        batch = []
+                n += len(self.bulk_create(batch))
+            return n
+
+        def minutes(self, person, start, end):
+            """
+            Minutes worked by person in [start, end). Sessions are clipped to
+            the range, open sessions count until now.
+            """
+            return self.minutes_by_person(start, end, people=[person]).get(person.pk, 0)
+
+        def minutes_by_person(self, start, end, people=None):
+            """
+            Minutes worked in [start, end) by everyone (or only people), in
+            one grouped query. Returns a dict of person ids to minutes, with
+            only the people who worked in the range.
+            """
+            sessions = self.overlapping(start, end)
+            if people is not None:
+                sessions = sessions.filter(person__in=people)
+            totals = (
+                sessions.values('person')
+                .order_by()
+                .annotate(total=self.worked(start, end))
+                .values_list('person', 'total')
+            )
+            return {
+                person_id: to_minutes(total) for person_id, total in totals if total
+            }
+
+        def overlapping(self, start, end):
+            """Sessions that overlap [start, end), open ones included."""
+            return self.filter(start__lt=end).filter(Q(end=None) | Q(end__gt=start))
+
+        def worked(self, start, end):
+            """
+            Aggregate of the time worked in [start, end) by the sessions it's
+            applied to, each clipped to the range. Open sessions count until
+            now.
+            """
+            now = Value(timezone.now(), output_field=models.DateTimeField())
+            clipped_end = Least(Coalesce('end', now), Value(end))
+            clipped_start = Greatest('start', Value(start))
+            return Sum(clipped_end - clipped_start, output_field=models.DurationField())
+
+    objects = SessionManager()
+
+    def __str__(self):
+        return f'{self.person} | {self.start} - {self.end or "now"}'
+
+
+class ScheduledTask(models.Model):
+    """
+    A periodic job of the scheduler command, and the lease of the worker
+    running it. Workers claim a due task with one conditional UPDATE, so
+    with several replicas only one of them runs it; a lease that isn't
+    released (the worker died) expires after the task's timeout.
+    """
+
+    name = models.CharField(primary_key=True)
+    next_run = models.DateTimeField(default=timezone.now)
+    leased_by = models.CharField(blank=True)
+    leased_until = models.DateTimeField(blank=True, null=True)
+
+    class ScheduledTaskManager(models.Manager):
+        def claim(self, name, worker, timeout, force=False):
+            """
+            Lease the task to worker for timeout seconds if it's due (or
+            anyway, with force) and nobody holds it. Returns whether the
+            lease was granted.
+            """
+            now = timezone.now()
+            self.bulk_create(
+                [self.model(name=name, next_run=now)], ignore_conflicts=True
+            )
+            tasks = self.filter(
+                Q(leased_until=None) | Q(leased_until__lt=now), name=name
+            )
+            if not force:
+                tasks = tasks.filter(next_run__lte=now)
+            return bool(
+                tasks.update(
+                    leased_by=worker, leased_until=now + timedelta(seconds=timeout)
+                )
+            )
+
+        def release(self, name, worker, next_run):
+            self.filter(name=name, leased_by=worker).update(
+                leased_by='', leased_until=None, next_run=next_run
+            )
+
+    objects = ScheduledTaskManager()
 
     def __str__(self):
         return self.name
 
 
+class TaskRun(models.Model):
+    """One run of a scheduled task, kept for the admin."""
+
+    task = models.ForeignKey(
+        ScheduledTask, on_delete=models.CASCADE, related_name='runs'
+    )
+    worker = models.CharField()
+    started = models.DateTimeField()
+    duration = models.DurationField()
+    succeeded = models.BooleanField()
+    result = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['task', 'started'], name='taskrun_task_started_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.task_id} | {self.started}'
+
+
+def microseconds(n):
+    return timedelta(microseconds=n)
+
+
+def to_minutes(duration):
+    """Whole minutes of a timedelta, or 0 for None."""
+    if not duration:
+        return 0
+    return max(0, int(duration.total_seconds() // 60))
+
+
+def log_order(log):
+    return (log.time, log.pk)
+
+
+def save_log(log):
+    """
+    Save a log and update the presence and sessions of its owner in one
+    transaction, and publish it to the events feed once committed.
+    """
+    with transaction.atomic():
+        log.save()
+        sessions = Session.objects.record(log)
+        Presence.objects.record(log, sessions=sessions)
+        transaction.on_commit(partial(events.hub.publish, [log]))
+    return log
+
+
+def save_logs(logs):
+    """Bulk version of save_log()."""
+    with transaction.atomic():
+        logs = Log.objects.bulk_create(logs)
+        sessions = Session.objects.record(*logs)
+        Presence.objects.record(*logs, sessions=sessions)
+        transaction.on_commit(partial(events.hub.publish, logs))
+    return logs
+
+
+def replay_logs(people):
+    """
+    Rebuild the sessions and presences of people from their logs, after
+    logs of theirs were changed or deleted, or added out of order.
+    """
+    with transaction.atomic():
+        Session.objects.rebuild(people=people)
+        Presence.objects.rebuild(people=people)
+
+
 def is_checked_in(user):
-    last_log = Log.objects.filter(tag__owner=user).order_by('-time').first()
-    print(last_log.id)
-    return last_log and last_log.type == Log.LogEntryType.CHECKIN
+    return Presence.objects.filter(pk=user.pk, state=Log.LogEntryType.CHECKIN).exists()
@@ -0,0 +1,137 @@
+"""
+Who is in the lab right now, grouped by subteam.
+
+The occupancy is loaded from Presence and the current memberships, and
+then kept up to date in memory by every log this process saves, so a wall
+display polling it costs no queries. Scans saved by other worker
+processes, and changes to memberships, show up when the snapshot expires
+after OCCUPANCY_TTL seconds.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import events
+from .models import Log, Membership, Presence, SubTeam, log_order
+
+
+class Occupancy:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.expires = 0
+        self.loading = None
+        self.checked_in = {}  # person id: (name, since)
+        self.order = {}  # person id: log_order() of their latest log
+        self.subteams = {}  # person id: (subteam id, subteam name)
+        self.data = None
+
+    def load(self):
+        with self.lock:
+            self.loading = []  # logs applied meanwhile
+        presences = Presence.objects.select_related('person')
+        memberships = Membership.objects.filter_effective().select_related('subteam')
+        checked_in = {}
+        order = {}
+        for presence in presences:
+            order[presence.person_id] = presence.order()
+            if presence.state == Log.LogEntryType.CHECKIN:
+                checked_in[presence.person_id] = (
+                    presence.person.get_full_name(),
+                    presence.since,
+                )
+        subteams = {
+            m.person_id: (m.subteam_id, m.subteam.name)
+            for m in memberships
+            if m.subteam_id is not None
+        }
+        with self.lock:
+            self.checked_in = checked_in
+            self.order = order
+            self.subteams = subteams
+            self.data = None
+            self.expires = time.monotonic() + self.ttl
+            logs, self.loading = self.loading, None
+            self.advance(logs)
+
+    def apply(self, logs):
+        """Bring the occupancy up to date with newly committed logs."""
+        with self.lock:
+            if self.loading is not None:
+                self.loading.extend(logs)
+            self.advance(logs)
+
+    def advance(self, logs):
+        for log in sorted(logs, key=log_order):
+            if not log.tag or log.tag.owner_id is None:
+                continue
+            person_id = log.tag.owner_id
+            if person_id in self.order and self.order[person_id] > log_order(log):
+                continue  # an older log arrived late
+            self.order[person_id] = log_order(log)
+            if log.type == Log.LogEntryType.CHECKIN:
+                self.checked_in[person_id] = (log.tag.owner.get_full_name(), log.time)
+            else:
+                self.checked_in.pop(person_id, None)
+            self.data = None
+
+    def clear(self):
+        with self.lock:
+            self.expires = 0
+
+    def get(self):
+        """The occupancy as served by the occupancy view."""
+        if time.monotonic() >= self.expires:
+            self.load()
+        with self.lock:
+            if self.data is None:
+                self.data = self.serialize()
+            return self.data
+
+    def serialize(self):
+        groups = {}
+        for person_id, (name, since) in self.checked_in.items():
+            subteam = self.subteams.get(person_id, (None, None))
+            groups.setdefault(subteam, []).append(
+                {'id': person_id, 'name': name, 'since': since.isoformat()}
+            )
+        subteams = [
+            {
+                'id': subteam_id,
+                'name': name,
+                'count': len(people),
+                'people': sorted(people, key=lambda p: p['since']),
+            }
+            # people without a subteam last
+            for (subteam_id, name), people in sorted(
+                groups.items(), key=lambda g: (g[0][0] is None, g[0][1] or '')
+            )
+        ]
+        return {'total': len(self.checked_in), 'subteams': subteams}
+
+
+current = Occupancy(getattr(settings, 'OCCUPANCY_TTL', 60))
+
+events.hub.connect(current.apply)
+
+
+@receiver(post_save, sender=Membership)
+@receiver(post_delete, sender=Membership)
+@receiver(post_save, sender=SubTeam)
+@receiver(post_delete, sender=SubTeam)
+@receiver(post_delete, sender=User)
+def invalidate(**kwargs):
+    current.clear()
+
+
+@receiver(post_save, sender=User)
+def invalidate_names(update_fields=None, **kwargs):
+    # logging in saves last_login, which doesn't concern names
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    current.clear()
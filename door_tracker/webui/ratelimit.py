@@ -0,0 +1,125 @@
+"""
+Token buckets limiting the scans per source address and per scanner.
+
+A scan takes a token from the bucket of the address it came from before
+the request is parsed, and one from the bucket of its scanner once the
+scanner is known; an upload of buffered scans takes one from the bucket
+of their scanner for every scan it hasn't seen before, and the scans
+left without a token are refused. Buckets hold up to `burst` tokens and refill at
+`per_minute` tokens a minute; a scan that finds its bucket empty gets a
+429 response. The defaults are the SCAN_ADDRESS_RATE_LIMIT and
+SCAN_RATE_LIMIT settings, (per_minute, burst) tuples or None for no
+limit; a Scanner can override its own.
+
+Buckets live in the default cache, so limits hold across worker
+processes only with a shared CACHES backend. Reading and writing a bucket
+isn't atomic, so concurrent scans can let a few more through.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def refill(bucket, now, per_minute, burst):
+    """Tokens in a (tokens, updated) bucket at now. A new bucket is full."""
+    if bucket is None:
+        return burst
+    tokens, updated = bucket
+    return min(burst, tokens + max(0, now - updated) * per_minute / 60)
+
+
+def take(key, per_minute, burst):
+    """
+    Take a token from the bucket. Returns 0 if there was one, otherwise the
+    seconds until there is. A per_minute of 0 is no limit.
+    """
+    if not per_minute:
+        return 0
+    now = time.time()
+    tokens = refill(cache.get(key), now, per_minute, burst)
+    if tokens < 1:
+        return (1 - tokens) * 60 / per_minute
+    # an idle bucket is full again after this, so it can expire
+    cache.set(key, (tokens - 1, now), int(burst * 60 / per_minute) + 1)
+    return 0
+
+
+def take_up_to(key, n, per_minute, burst):
+    """Take up to n tokens from the bucket. Returns how many it had."""
+    if not per_minute:
+        return n
+    now = time.time()
+    tokens = refill(cache.get(key), now, per_minute, burst)
+    taken = min(n, int(tokens))
+    if taken:
+        cache.set(key, (tokens - taken, now), int(burst * 60 / per_minute) + 1)
+    return taken
+
+
+async def atake(key, per_minute, burst):
+    if not per_minute:
+        return 0
+    now = time.time()
+    tokens = refill(await cache.aget(key), now, per_minute, burst)
+    if tokens < 1:
+        return (1 - tokens) * 60 / per_minute
+    await cache.aset(key, (tokens - 1, now), int(burst * 60 / per_minute) + 1)
+    return 0
+
+
+def address_limit():
+    per_minute, burst = getattr(settings, 'SCAN_ADDRESS_RATE_LIMIT', (600, 120)) or (
+        0,
+        0,
+    )
+    return per_minute, max(1, burst)
+
+
+def client_address(request):
+    """
+    The address request came from. Behind a reverse proxy REMOTE_ADDR is the
+    proxy's, the same for every scanner; set SCAN_ADDRESS_HEADER to the META
+    key of the header the proxy puts the client address in (e.g.
+    HTTP_X_FORWARDED_FOR). The last address in it is the one the proxy
+    added; any before it came from the client and can't be trusted.
+    """
+    header = getattr(settings, 'SCAN_ADDRESS_HEADER', None)
+    if header and (forwarded := request.META.get(header)):
+        return forwarded.rsplit(',', 1)[-1].strip()
+    return request.META.get('REMOTE_ADDR')
+
+
+def scanner_limit(scanner):
+    per_minute, burst = getattr(settings, 'SCAN_RATE_LIMIT', (120, 30)) or (0, 0)
+    if scanner.scans_per_minute is not None:
+        per_minute = scanner.scans_per_minute
+    if scanner.scan_burst is not None:
+        burst = scanner.scan_burst
+    return per_minute, max(1, burst)
+
+
+def limit_address(request):
+    """Seconds until a scan from the address of request is allowed, or 0."""
+    key = f'ratelimit:address:{client_address(request)}'
+    return take(key, *address_limit())
+
+
+async def alimit_address(request):
+    key = f'ratelimit:address:{client_address(request)}'
+    return await atake(key, *address_limit())
+
+
+def limit_scanner(scanner):
+    """Seconds until a scan of scanner is allowed, or 0."""
+    return take(f'ratelimit:scanner:{scanner.pk}', *scanner_limit(scanner))
+
+
+async def alimit_scanner(scanner):
+    return await atake(f'ratelimit:scanner:{scanner.pk}', *scanner_limit(scanner))
+
+
+def allow_scans(scanner, n):
+    """How many of n uploaded scans of scanner are allowed, taking their tokens."""
+    return take_up_to(f'ratelimit:scanner:{scanner.pk}', n, *scanner_limit(scanner))
@@ -0,0 +1,143 @@
+"""
+Weekly and monthly quota compliance of every member, grouped by subteam.
+
+One query reads the memberships in effect at the end of the period, each
+annotated with the time its person worked in the period (a correlated
+aggregate over their sessions, served by the person/start index). Reports
+are cached for QUOTA_REPORT_TTL seconds.
+"""
+
+import csv
+import io
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models
+from django.db.models import F, OuterRef, Subquery
+from django.utils import timezone
+
+from . import series, utils
+from .models import Membership, Session, to_minutes
+
+UNITS = ('week', 'month')
+
+# a month's quota, in weeks of quota, as in get_statistics
+WEEKS_PER_MONTH = 4
+
+CSV_FIELDS = ['subteam', 'person', 'username', 'job', 'minutes', 'quota', 'met']
+
+
+def period(day, unit):
+    """The first and last day of the week or month that day is in."""
+    first = series.bucket_start(day, unit)
+    return first, series.next_bucket(first, unit) - timedelta(days=1)
+
+
+def memberships(first, last):
+    """
+    The memberships in effect at the end of first..last (or now, for the
+    current period), annotated with `worked`: the time their person worked
+    in the period.
+    """
+    start, end = utils.day_range(first, last)
+    worked = (
+        Session.objects.overlapping(start, end)
+        .filter(person=OuterRef('person'))
+        .values('person')
+        .order_by()
+        .annotate(total=Session.objects.worked(start, end))
+        .values('total')
+    )
+    return (
+        Membership.objects.effective_at(min(end, timezone.now()))
+        .filter(person__is_active=True)
+        .select_related('person', 'subteam', 'job')
+        .annotate(worked=Subquery(worked, output_field=models.DurationField()))
+        .order_by(
+            F('subteam__name').asc(nulls_last=True),
+            'subteam',
+            'person__first_name',
+            'person__last_name',
+            'person__username',
+        )
+    )
+
+
+def build(day, unit):
+    first, last = period(day, unit)
+    weeks = 1 if unit == 'week' else WEEKS_PER_MONTH
+    subteams = []
+    for membership in memberships(first, last):
+        subteam = membership.subteam
+        if not subteams or subteams[-1]['id'] != (subteam and subteam.pk):
+            subteams.append(
+                {
+                    'id': subteam and subteam.pk,
+                    'name': subteam.name if subteam else None,
+                    'met': 0,
+                    'members': [],
+                }
+            )
+        job = membership.job
+        minutes = to_minutes(membership.worked)
+        quota = job.quota * 60 * weeks if job else None
+        met = quota is not None and minutes >= quota
+        subteams[-1]['met'] += met
+        subteams[-1]['members'].append(
+            {
+                'id': membership.person_id,
+                'name': membership.person.get_full_name(),
+                'username': membership.person.username,
+                'job': job.name if job else None,
+                'minutes': minutes,
+                'quota': quota,
+                'met': met if quota is not None else None,
+            }
+        )
+    return {
+        'unit': unit,
+        'start': first.isoformat(),
+        'end': last.isoformat(),
+        'subteams': subteams,
+    }
+
+
+def cache_key(day, unit):
+    return f'quota_report:{unit}:{period(day, unit)[0].isoformat()}'
+
+
+def report(day, unit):
+    """The quota report of the week or month that day is in, cached."""
+    return cache.get_or_set(
+        cache_key(day, unit),
+        lambda: build(day, unit),
+        getattr(settings, 'QUOTA_REPORT_TTL', 300),
+    )
+
+
+def refresh(day, unit):
+    """Rebuild the cached report, e.g. ahead of the people asking for it."""
+    report = build(day, unit)
+    cache.set(cache_key(day, unit), report, getattr(settings, 'QUOTA_REPORT_TTL', 300))
+    return report
+
+
+def to_csv(report):
+    out = io.StringIO()
+    writer = csv.writer(out, dialect='excel')
+    writer.writerow(CSV_FIELDS)
+    for subteam in report['subteams']:
+        for member in subteam['members']:
+            writer.writerow(
+                [
+                    subteam['name'] or '',
+                    member['name'],
+                    member['username'],
+                    member['job'] or '',
+                    member['minutes'],
+                    '' if member['quota'] is None else member['quota'],
+                    '' if member['met'] is None else member['met'],
+                ]
+            )
+    return out.getvalue()
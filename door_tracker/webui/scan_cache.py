@@ -0,0 +1,262 @@
+"""
+In-process cache of the Scanner and Tag lookups done on every scan.
+
+Scanners and tags almost never change, so register_scan keeps them in a
+bounded LRU cache with a TTL. The caches hold field values, and every
+lookup builds new instances from them: requests and the writer change the
+instances they get (a tag's owner gets its new presence), so they can't
+share them. Unknown scanner ids are remembered in a cache of their own,
+so that requests with made-up ids can't push the real scanners out.
+Saving or deleting a Scanner, Tag or User clears the matching cache in
+this process; other worker processes pick the change up when their
+entries expire.
+
+A card held on a reader is read several times a second. The response to
+a scan is kept for SCAN_DEBOUNCE_SECONDS (2 by default, 0 turns it off)
+per scanner and card, and repeats inside that window get it again without
+touching the database. Responses are kept in the default cache once their
+scan is committed, so that with a shared CACHES backend a repeat handled
+by another worker process is answered the same way. They outlive changes
+to their scanner or tag by at most the window.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import router, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import metrics
+from .models import Scanner, Tag
+
+MISSING = object()
+
+
+class LRUCache:
+    """A thread-safe LRU cache whose entries expire after ttl seconds."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the cached value, or MISSING."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return MISSING
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+scanners = LRUCache(
+    getattr(settings, 'SCAN_CACHE_SIZE', 10_000),
+    getattr(settings, 'SCAN_CACHE_TTL', 60),
+)
+unknown_scanners = LRUCache(
+    getattr(settings, 'SCAN_CACHE_MISSES', 1000),
+    getattr(settings, 'SCAN_CACHE_TTL', 60),
+)
+tags = LRUCache(
+    getattr(settings, 'SCAN_CACHE_SIZE', 10_000),
+    getattr(settings, 'SCAN_CACHE_TTL', 60),
+)
+
+
+def clear():
+    scanners.clear()
+    unknown_scanners.clear()
+    tags.clear()
+
+
+def stats():
+    return {
+        'scanners': scanners.stats(),
+        'unknown_scanners': unknown_scanners.stats(),
+        'tags': tags.stats(),
+    }
+
+
+metrics.Counter(
+    'door_scan_cache_requests_total',
+    'Scanner and tag cache lookups in register_scan, by cache and result.',
+    ['cache', 'result'],
+    collect=lambda: {
+        (name, result): cache_stats[key]
+        for name, cache_stats in stats().items()
+        for result, key in (('hit', 'hits'), ('miss', 'misses'))
+    },
+)
+
+
+def to_row(instance):
+    """The field values of a model instance, to cache instead of it."""
+    return tuple(getattr(instance, f.attname) for f in instance._meta.concrete_fields)
+
+
+def from_row(model, row):
+    """A new instance of model, as if loaded from the database."""
+    fields = [f.attname for f in model._meta.concrete_fields]
+    return model.from_db(router.db_for_read(model), fields, row)
+
+
+def cache_scanner(scanner_id, scanner):
+    if scanner is None:
+        unknown_scanners.set(scanner_id, True)
+    else:
+        scanners.set(scanner_id, to_row(scanner))
+    return scanner
+
+
+def cached_scanner(scanner_id):
+    """The cached scanner with this id, None if it's unknown, or MISSING."""
+    row = scanners.get(scanner_id)
+    if row is not MISSING:
+        return from_row(Scanner, row)
+    if unknown_scanners.get(scanner_id) is not MISSING:
+        return None
+    return MISSING
+
+
+def get_scanner(scanner_id):
+    """Scanner with this id, or None. Unknown scanners are cached too."""
+    scanner = cached_scanner(scanner_id)
+    if scanner is MISSING:
+        scanner = cache_scanner(
+            scanner_id, Scanner.objects.filter(pk=scanner_id).first()
+        )
+    return scanner
+
+
+async def aget_scanner(scanner_id):
+    scanner = cached_scanner(scanner_id)
+    if scanner is MISSING:
+        scanner = cache_scanner(
+            scanner_id, await Scanner.objects.filter(pk=scanner_id).afirst()
+        )
+    return scanner
+
+
+def cache_tag(card_id, tag):
+    if tag is not None:
+        owner = tag.owner and to_row(tag.owner)
+        tags.set(card_id, (to_row(tag), owner))
+    return tag
+
+
+def cached_tag(card_id):
+    """The cached tag (with its owner) of this card, or MISSING."""
+    entry = tags.get(card_id)
+    if entry is MISSING:
+        return MISSING
+    row, owner = entry
+    tag = from_row(Tag, row)
+    if owner is not None:
+        tag.owner = from_row(User, owner)
+    return tag
+
+
+def get_tag(card_id):
+    """Tag (with its owner) of this card, or None. Misses are not cached."""
+    tag = cached_tag(card_id)
+    if tag is MISSING:
+        tag = cache_tag(
+            card_id, Tag.objects.select_related('owner').filter(tag=card_id).first()
+        )
+    return tag
+
+
+async def aget_tag(card_id):
+    tag = cached_tag(card_id)
+    if tag is MISSING:
+        tag = cache_tag(
+            card_id,
+            await Tag.objects.select_related('owner').filter(tag=card_id).afirst(),
+        )
+    return tag
+
+
+def debounce_seconds():
+    return getattr(settings, 'SCAN_DEBOUNCE_SECONDS', 2)
+
+
+def recent_key(scanner_id, card_id):
+    # scanner ids are secrets and can hold characters cache keys can't
+    digest = hashlib.sha256(scanner_id.encode() + b'\0' + card_id).hexdigest()
+    return f'scan:recent:{digest}'
+
+
+def get_recent(scanner_id, card_id):
+    """(scanner, status, content) of a scan inside the window, or None."""
+    if not debounce_seconds():
+        return None
+    return cache.get(recent_key(scanner_id, card_id))
+
+
+async def aget_recent(scanner_id, card_id):
+    if not debounce_seconds():
+        return None
+    return await cache.aget(recent_key(scanner_id, card_id))
+
+
+def set_recent(scanner, card_id, response):
+    """
+    Keep the response to a scan for the window, from when the transaction
+    writing the scan commits: a scan that's rolled back is not repeated.
+    """
+    if seconds := debounce_seconds():
+        value = (scanner, response.status_code, response.content)
+        transaction.on_commit(
+            partial(cache.set, recent_key(scanner.pk, card_id), value, seconds)
+        )
+
+
+@receiver(post_save, sender=Scanner)
+@receiver(post_delete, sender=Scanner)
+def invalidate_scanners(**kwargs):
+    scanners.clear()
+    unknown_scanners.clear()
+
+
+# a tag can change its card, so drop all tags
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=User)
+def invalidate_tags(**kwargs):
+    tags.clear()
+
+
+@receiver(post_save, sender=User)
+def invalidate_owners(update_fields=None, **kwargs):
+    # logging in saves last_login, which doesn't concern tags
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    tags.clear()
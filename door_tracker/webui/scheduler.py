@@ -0,0 +1,182 @@
+"""
+Periodic background jobs, run by `django scheduler`.
+
+Every task runs at most once per interval across all workers: a worker
+runs a task only after leasing its ScheduledTask row (see
+ScheduledTask.objects.claim). Runs are recorded as TaskRun rows, which the
+admin lists with their duration and result. Intervals can be changed with
+the SCHEDULE setting, a dict of task names to seconds.
+"""
+
+import logging
+import os
+import socket
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from . import reports
+from .models import (
+    ArchivedLog,
+    Log,
+    Presence,
+    ScheduledTask,
+    Statistics,
+    Tag,
+    TaskRun,
+    save_logs,
+)
+
+logger = logging.getLogger(__name__)
+
+# people checked out per transaction by auto_checkout
+BATCH_SIZE = 500
+
+
+class Task:
+    def __init__(self, name, fn, interval, timeout):
+        self.name = name
+        self.fn = fn
+        # seconds between runs, unless SCHEDULE says otherwise
+        self.interval = interval
+        # seconds before the lease of a worker that didn't finish expires
+        self.timeout = timeout
+
+    @property
+    def every(self):
+        return getattr(settings, 'SCHEDULE', {}).get(self.name, self.interval)
+
+
+TASKS = {}
+
+
+def task(interval, timeout=600):
+    def register(fn):
+        TASKS[fn.__name__] = Task(fn.__name__, fn, interval, timeout)
+        return fn
+
+    return register
+
+
+@task(interval=5 * 60)
+def rollup_statistics():
+    """Statistics of today, and of yesterday until it's complete."""
+    today = timezone.localdate()
+    rows = Statistics.objects.rollup(today - timedelta(days=1), today)
+    return f'{len(rows)} statistics'
+
+
+def last_cutoff(now):
+    """The latest AUTO_CHECKOUT_AT (local time, 04:00 by default) before now."""
+    at = datetime.strptime(getattr(settings, 'AUTO_CHECKOUT_AT', '04:00'), '%H:%M')
+    day = timezone.localdate(now)
+    cutoff = timezone.make_aware(datetime.combine(day, at.time()))
+    if cutoff > now:
+        cutoff = timezone.make_aware(
+            datetime.combine(day - timedelta(days=1), at.time())
+        )
+    return cutoff
+
+
+@task(interval=5 * 60)
+def auto_checkout():
+    """
+    Check out everyone who checked in before the last cutoff and never
+    checked out, at the cutoff, so that forgotten sessions stop growing.
+    """
+    cutoff = last_cutoff(timezone.now())
+    forgotten = (
+        Presence.objects.filter(state=Log.LogEntryType.CHECKIN, since__lt=cutoff)
+        .select_related('last_log__tag')
+        .order_by('pk')
+    )
+    n = 0
+    batch = list(forgotten[:BATCH_SIZE])
+    while batch:
+        # the tag they checked in with, unless it has changed hands since
+        tags = {
+            p.person_id: p.last_log.tag
+            for p in batch
+            if p.last_log and p.last_log.tag and p.last_log.tag.owner_id == p.person_id
+        }
+        missing = [p.person_id for p in batch if p.person_id not in tags]
+        for tag in Tag.objects.filter(owner__in=missing).order_by('-pk'):
+            tags.setdefault(tag.owner_id, tag)
+        # people without a tag are skipped: nothing can check them out
+        logs = [
+            Log(type=Log.LogEntryType.CHECKOUT, tag=tags[p.person_id], time=cutoff)
+            for p in batch
+            if p.person_id in tags
+        ]
+        if logs:
+            save_logs(logs)
+            n += len(logs)
+        # after the people just handled or skipped, who may still be IN
+        batch = list(forgotten.filter(pk__gt=batch[-1].pk)[:BATCH_SIZE])
+    return f'{n} checked out at {cutoff:%Y-%m-%d %H:%M}'
+
+
+@task(interval=10 * 60)
+def warm_caches():
+    """
+    Build this week's and this month's quota reports ahead of the leads.
+    Only useful with a cache shared by all processes (CACHES).
+    """
+    today = timezone.localdate()
+    for unit in reports.UNITS:
+        reports.refresh(today, unit)
+    return f'{len(reports.UNITS)} quota reports'
+
+
+@task(interval=24 * 60 * 60, timeout=60 * 60)
+def archive_logs():
+    n = ArchivedLog.objects.archive(ArchivedLog.objects.horizon())
+    return f'{n} logs archived'
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def run(task, worker, force=False):
+    """
+    Run task if it's due and this worker gets its lease. Returns the
+    TaskRun, or None if the task didn't run.
+    """
+    if not ScheduledTask.objects.claim(task.name, worker, task.timeout, force):
+        return None
+    started = timezone.now()
+    clock = time.perf_counter()
+    try:
+        result, succeeded = task.fn() or '', True
+    except Exception:
+        logger.exception('scheduled task %s failed', task.name)
+        result, succeeded = traceback.format_exc(), False
+    duration = timedelta(seconds=time.perf_counter() - clock)
+    ScheduledTask.objects.release(
+        task.name, worker, started + timedelta(seconds=task.every)
+    )
+    return TaskRun.objects.create(
+        task_id=task.name,
+        worker=worker,
+        started=started,
+        duration=duration,
+        succeeded=succeeded,
+        result=result,
+    )
+
+
+def run_due(worker, names=None, force=False):
+    """Run the due tasks (or the named ones), one after the other."""
+    runs = []
+    for name, task in TASKS.items():
+        if names is not None and name not in names:
+            continue
+        close_old_connections()
+        if finished := run(task, worker, force):
+            runs.append(finished)
+    return runs
@@ -0,0 +1,133 @@
+"""
+Minutes worked per day, ISO week or month over a range of days.
+
+The sessions overlapping the range are read in one query and split at
+local midnights (or the first day of the week or month), so a session that
+runs past midnight counts for both days, like in Statistics. The closed
+sessions are cached per person and range, keyed by the id of the person's
+latest log: the next scan (or status change) starts a new key. An open
+session is added on top of the cached part, so it keeps growing until the
+check-out. Buffered scans uploaded late don't move the latest log, they
+show up when the entry expires after STATISTICS_SERIES_TTL seconds.
+"""
+
+from bisect import bisect_right
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from . import utils
+from .models import Log, Presence, Session
+
+UNITS = ('day', 'week', 'month')
+
+
+def bucket_start(day, unit):
+    """The first day of the bucket of unit that day is in."""
+    match unit:
+        case 'day':
+            return day
+        case 'week':
+            return day - timedelta(days=day.weekday())
+        case 'month':
+            return day.replace(day=1)
+    raise ValueError(f'unknown unit {unit!r}')
+
+
+def next_bucket(day, unit):
+    """The first day of the bucket after the one starting on day."""
+    match unit:
+        case 'day':
+            return day + timedelta(days=1)
+        case 'week':
+            return day + timedelta(weeks=1)
+        case 'month':
+            return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+    raise ValueError(f'unknown unit {unit!r}')
+
+
+def label(day, unit):
+    match unit:
+        case 'day':
+            return day.isoformat()
+        case 'week':
+            year, week, _ = day.isocalendar()
+            return f'{year}-W{week:02}'
+        case 'month':
+            return f'{day:%Y-%m}'
+    raise ValueError(f'unknown unit {unit!r}')
+
+
+def buckets(first, last, unit):
+    """The first days of the buckets covering first..last, in order."""
+    days = []
+    day = bucket_start(first, unit)
+    while day <= last:
+        days.append(day)
+        day = next_bucket(day, unit)
+    return days
+
+
+def split_seconds(intervals, first, last, unit):
+    """
+    Seconds of the (start, end) intervals that fall in each bucket of
+    first..last, clipped to the range. Returns a list parallel to
+    buckets(first, last, unit).
+    """
+    days = buckets(first, last, unit)
+    range_start, range_end = utils.day_range(first, last)
+    # boundaries[i] is where bucket i starts, the first one clipped to the range
+    boundaries = [range_start, *(utils.start_of_day(day) for day in days[1:])]
+    seconds = [0.0] * len(days)
+    for start, end in intervals:
+        start, end = max(start, range_start), min(end, range_end)
+        i = bisect_right(boundaries, start) - 1
+        while start < end:
+            bucket_end = boundaries[i + 1] if i + 1 < len(days) else range_end
+            seconds[i] += (min(end, bucket_end) - start).total_seconds()
+            start = bucket_end
+            i += 1
+    return seconds
+
+
+def closed_seconds(person, first, last, unit):
+    """split_seconds() of the closed sessions of person, in one query."""
+    start, end = utils.day_range(first, last)
+    sessions = Session.objects.filter(
+        person=person, start__lt=end, end__gt=start
+    ).values_list('start', 'end')
+    return split_seconds(sessions, first, last, unit)
+
+
+def minutes(person, first, last, unit):
+    """
+    [(bucket first day, minutes)] for every bucket of unit in first..last,
+    including the empty ones.
+    """
+    presence = Presence.objects.filter(person=person).first()
+    key = ':'.join(
+        [
+            'statistics_series',
+            str(person.pk),
+            unit,
+            first.isoformat(),
+            last.isoformat(),
+            str(presence and presence.last_log_id),
+        ]
+    )
+    seconds = cache.get(key)
+    if seconds is None:
+        seconds = closed_seconds(person, first, last, unit)
+        cache.set(key, seconds, getattr(settings, 'STATISTICS_SERIES_TTL', 86400))
+    if presence and presence.state == Log.LogEntryType.CHECKIN:
+        # the open session started with the check-in and runs until now
+        open_seconds = split_seconds(
+            [(presence.since, timezone.now())], first, last, unit
+        )
+        seconds = [a + b for a, b in zip(seconds, open_seconds, strict=True)]
+    return [
+        (day, int(s // 60))
+        for day, s in zip(buckets(first, last, unit), seconds, strict=True)
+    ]
@@ -1 +1,1601 @@
-# Create your tests here.
+import asyncio
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import random
+import subprocess
+import tempfile
+import time
+from base64 import b64encode
+from datetime import date, timedelta
+from itertools import chain
+from pathlib import Path
+from unittest import mock
+
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.http import JsonResponse
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import (
+    events,
+    metrics,
+    occupancy,
+    ratelimit,
+    reports,
+    scan_cache,
+    scheduler,
+    utils,
+    views,
+    worktime,
+)
+from .models import (
+    ArchivedLog,
+    Job,
+    Log,
+    Membership,
+    Presence,
+    Scanner,
+    ScheduledTask,
+    Session,
+    Statistics,
+    SubTeam,
+    Tag,
+    TaskRun,
+    save_log,
+    save_logs,
+)
+from .writer import writer
+
+CARD = b'\xde\xad\xbe\xef'
+
+
+def full_table_scans(sql):
+    """
+    Runs EXPLAIN on a SELECT statement and returns the plan lines that read
+    a whole table.
+    """
+    with connection.cursor() as cursor:
+        match connection.vendor:
+            case 'sqlite':
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                lines = [row[-1] for row in cursor.fetchall()]
+                # "SCAN t USING INDEX i" walks an index, "SCAN t" walks the table
+                return [
+                    line
+                    for line in lines
+                    if line.startswith('SCAN ')
+                    and 'USING' not in line
+                    and 'CONSTANT ROW' not in line
+                ]
+            case 'postgresql':
+                # tables in tests are tiny, only fall back to a seq scan if
+                # there is no index to use at all
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute(f'EXPLAIN {sql}')
+                lines = [row[0] for row in cursor.fetchall()]
+                return [line for line in lines if 'Seq Scan' in line]
+            case vendor:
+                raise NotImplementedError(f'no query plan checker for {vendor}')
+
+
+class ViewTestCase(TestCase):
+    """A user with a tag, logs and statistics, logged in to the client."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            'alice',
+            password='secret',
+            first_name='Alice',
+            last_name='Doe',
+            is_staff=True,
+        )
+        cls.scanner = Scanner.objects.create(id='door', name='Door')
+        cls.tag = Tag.objects.create(tag=CARD, name='card', owner=cls.user)
+        job = Job.objects.create(name='Member', quota=10)
+        subteam = SubTeam.objects.create(name='Software')
+        Membership.objects.create(person=cls.user, subteam=subteam, job=job)
+        now = timezone.now()
+        for i, type in enumerate([Log.LogEntryType.CHECKIN, Log.LogEntryType.CHECKOUT]):
+            save_log(
+                Log(
+                    type=type,
+                    tag=cls.tag,
+                    scanner=cls.scanner,
+                    time=now - timedelta(minutes=2 - i),
+                )
+            )
+        Statistics.objects.create(
+            person=cls.user,
+            day=timezone.localdate(),
+            minutes_day=1,
+            minutes_week=1,
+            minutes_month=1,
+            average_week=1,
+            total_minutes=1,
+        )
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        scan_cache.clear()
+        # rate limits and repeated scans
+        cache.clear()
+
+    def view_request(self, name):
+        """Sends a typical request to the view called name."""
+        card = b64encode(CARD).decode()
+        match name:
+            case 'register_scan':
+                return self.client.post(
+                    reverse(name),
+                    data={'device_id': 'door', 'card_id': card},
+                    content_type='application/json',
+                )
+            case 'register_scans':
+                return self.client.post(
+                    reverse(name),
+                    data=[
+                        {
+                            'device_id': 'door',
+                            'card_id': b64encode(c).decode(),
+                            'scanned_at': timezone.now().isoformat(),
+                            'idempotency_key': f'key-{i}',
+                        }
+                        for i, c in enumerate([CARD, b'unknown'])
+                    ],
+                    content_type='application/json',
+                )
+            case 'change_status':
+                return self.client.post(
+                    reverse(name),
+                    data={'tag_id': card},
+                    content_type='application/json',
+                )
+            case 'statistics_series':
+                today = timezone.localdate()
+                query = {'start': today - timedelta(days=30), 'end': today}
+                return self.client.get(reverse(name, query=query))
+            case 'export':
+                today = timezone.localdate()
+                query = {'start': today, 'end': today, 'person': self.user.pk}
+                return self.client.get(reverse(name, query=query))
+            case _:
+                return self.client.get(reverse(name))
+
+    def captured_queries(self, name):
+        """Sends view_request(name) and returns the queries it ran."""
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.view_request(name)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertLess(response.status_code, 500)
+        return ctx.captured_queries
+
+
+class QueryPlanTests(ViewTestCase):
+    """Every query issued by the hot views must be served by an index."""
+
+    # tables that are small by nature, scanning them is fine
+    SMALL_TABLES = ('webui_scanner', 'webui_subteam', 'webui_job')
+
+    def assertIndexed(self, name):
+        queries = self.captured_queries(name)
+        selects = [q['sql'] for q in queries if q['sql'].startswith('SELECT')]
+        self.assertTrue(selects, f'{name} issued no queries')
+        for sql in selects:
+            scans = [
+                line
+                for line in full_table_scans(sql)
+                if not any(table in line for table in self.SMALL_TABLES)
+            ]
+            self.assertFalse(scans, f'full table scan in {name}:\n{sql}\n{scans}')
+
+    def test_register_scan(self):
+        self.assertIndexed('register_scan')
+
+    def test_register_scans(self):
+        self.assertIndexed('register_scans')
+
+    def test_check_status(self):
+        self.assertIndexed('check_status')
+
+    def test_change_status(self):
+        self.assertIndexed('change_status')
+
+    def test_current_user_data(self):
+        self.assertIndexed('utable_data')
+
+    def test_save_statistics(self):
+        self.assertIndexed('save_statistics')
+
+    def test_get_statistics(self):
+        self.assertIndexed('get_statistics')
+
+    def test_export(self):
+        self.assertIndexed('export')
+
+    def test_statistics_series(self):
+        self.assertIndexed('statistics_series')
+
+
+# Maximum number of queries per request, by URL name. Raise a budget only
+# when the extra queries are worth it.
+QUERY_BUDGETS = {
+    'register_scan': 13,
+    'register_scans': 17,
+    'check_status': 3,
+    'change_status': 11,
+    'utable_data': 3,
+    'save_statistics': 11,
+    'get_statistics': 5,
+    # session, user, presence, then sessions when the cached series is stale
+    'statistics_series': 4,
+    # session, user, then the archived and the live logs
+    'export': 4,
+    # session, user, then presences and memberships when the snapshot expired
+    'occupancy': 4,
+}
+
+
+class QueryBudgetTests(ViewTestCase):
+    def test_query_budgets(self):
+        for name, budget in QUERY_BUDGETS.items():
+            with self.subTest(name):
+                queries = self.captured_queries(name)
+                self.assertLessEqual(
+                    len(queries),
+                    budget,
+                    f'{name} ran {len(queries)} queries, over its budget of '
+                    f'{budget}:\n' + '\n'.join(q['sql'] for q in queries),
+                )
+
+    def test_server_timing(self):
+        response = self.client.get(reverse('check_status'))
+        self.assertRegex(response['Server-Timing'], r'db;dur=[\d.]+;desc="\d+ queries"')
+
+
+class MetricsTests(ViewTestCase):
+    def sample(self, text, line):
+        """Value of the sample starting with line, or 0."""
+        for sample in text.splitlines():
+            if sample.startswith(line + ' '):
+                return float(sample.rsplit(' ', 1)[1])
+        return 0
+
+    def test_scans_are_counted(self):
+        line = 'door_scans_total{scanner="Door",outcome="claimed"}'
+        before = self.sample(self.client.get(reverse('metrics')).text, line)
+        self.view_request('register_scan')
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4')
+        self.assertEqual(self.sample(response.text, line), before + 1)
+        self.assertIn('door_scan_duration_seconds_bucket{', response.text)
+        self.assertIn('door_scan_cache_requests_total{', response.text)
+
+    @override_settings(METRICS_TOKEN='s3cret')
+    def test_needs_staff_or_the_token(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        for token in ['wrong', 's3cret']:
+            response = self.client.get(
+                reverse('metrics'), headers={'Authorization': f'Bearer {token}'}
+            )
+            self.assertEqual(response.status_code, 403 if token == 'wrong' else 200)
+
+        self.user.is_staff = False
+        self.user.save()
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+
+    async def test_malformed_scans_are_counted(self):
+        before = metrics.SCANS.values['', 'invalid']
+        for name in ['register_scan', 'aregister_scan']:
+            response = await self.async_client.post(
+                reverse(name), data='{not json', content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(
+                response.json()['message'], 'Invalid request: malformed JSON'
+            )
+        self.assertEqual(metrics.SCANS.values['', 'invalid'], before + 2)
+
+    def test_snapshots_of_dead_processes_are_pruned(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = metrics.FileStore(directory, interval=1, stale_after=3600)
+            store.flush()
+            finished = subprocess.Popen(['true'])
+            finished.wait()
+            paths = {
+                'alive': Path(directory, f'{os.getppid()}.json'),
+                'dead': Path(directory, f'{finished.pid}.json'),
+                'stale': Path(directory, f'{os.getppid()}0.json'),
+            }
+            for path in paths.values():
+                path.write_text(json.dumps(metrics.snapshot()))
+            os.utime(paths['stale'], (0, 0))
+
+            self.assertEqual(len(store.others()), 1)
+            self.assertEqual(
+                {path.name for path in Path(directory).glob('*.json')},
+                {store.path.name, paths['alive'].name},
+            )
+
+    def test_merge(self):
+        snapshot = metrics.snapshot()
+        merged = metrics.merge([snapshot, snapshot])
+        for name, metric in snapshot.items():
+            for key, *values in metric['samples']:
+                if metric['type'] == 'counter':
+                    self.assertEqual(
+                        merged[name]['samples'][tuple(key)], [2 * values[0]]
+                    )
+                else:
+                    self.assertEqual(
+                        merged[name]['samples'][tuple(key)][1], 2 * values[1]
+                    )
+
+
+class DebounceTests(ViewTestCase):
+    def scan(self):
+        return self.client.post(
+            reverse('register_scan'),
+            data={'device_id': 'door', 'card_id': b64encode(CARD).decode()},
+            content_type='application/json',
+        )
+
+    def test_repeats_get_the_same_response(self):
+        # scanners don't log in
+        self.client.logout()
+        key = ('Door', 'duplicate')
+        before = metrics.SCANS.values[key]
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self.scan()
+        with self.assertNumQueries(0):
+            repeats = [self.scan() for _ in range(3)]
+        for repeat in repeats:
+            self.assertEqual(repeat.status_code, first.status_code)
+            self.assertEqual(repeat.json(), first.json())
+        self.assertEqual(Log.objects.count(), 3)
+        self.assertEqual(metrics.SCANS.values[key], before + 3)
+
+    def test_window(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.scan()
+        with override_settings(SCAN_DEBOUNCE_SECONDS=0):
+            self.scan()
+            self.scan()
+        self.assertEqual(Log.objects.count(), 5)
+
+    def test_repeat_on_another_worker(self):
+        # the first scan is committed, but its response isn't in the cache
+        # of the process that gets the repeat
+        first = self.scan()
+        self.assertIsNone(scan_cache.get_recent('door', CARD))
+        repeat = self.scan()
+        self.assertEqual(repeat.json(), first.json())
+        self.assertEqual(Log.objects.count(), 3)
+
+    def test_rolled_back_scans_are_not_repeated(self):
+        scanner = Scanner.objects.get(pk='door')
+        with (
+            self.captureOnCommitCallbacks(execute=True),
+            self.assertRaises(IntegrityError),
+            transaction.atomic(),
+        ):
+            views.handle_scan(scanner, self.tag, CARD)
+            raise IntegrityError
+        self.assertIsNone(scan_cache.get_recent('door', CARD))
+        self.assertEqual(Log.objects.count(), 2)
+
+
+@override_settings(SCAN_DEBOUNCE_SECONDS=0)
+class RateLimitTests(ViewTestCase):
+    def setUp(self):
+        super().setUp()
+        # scanners don't log in
+        self.client.logout()
+
+    def scan(self, device_id='door'):
+        return self.client.post(
+            reverse('register_scan'),
+            data={'device_id': device_id, 'card_id': b64encode(CARD).decode()},
+            content_type='application/json',
+        )
+
+    def test_refill(self):
+        self.assertEqual(ratelimit.refill(None, 100, 60, 5), 5)
+        self.assertEqual(ratelimit.refill((0.5, 100), 101, 60, 5), 1.5)
+        self.assertEqual(ratelimit.refill((0, 100), 200, 60, 5), 5)
+
+    def test_scanner_limit(self):
+        Scanner.objects.filter(pk='door').update(scans_per_minute=1, scan_burst=2)
+        key = ('Door', 'rate_limited')
+        before = metrics.SCANS.values[key]
+        self.assertEqual(self.scan().status_code, 200)
+        self.assertEqual(self.scan().status_code, 200)
+        with self.assertNumQueries(0):
+            response = self.scan()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '60')
+        self.assertEqual(metrics.SCANS.values[key], before + 1)
+        self.assertEqual(Log.objects.count(), 4)
+        # other scanners have their own bucket
+        Scanner.objects.create(id='window', name='Window')
+        self.assertEqual(self.scan('window').status_code, 200)
+
+    @override_settings(SCAN_ADDRESS_RATE_LIMIT=(60, 1))
+    def test_address_limit(self):
+        self.assertEqual(self.scan('unknown').status_code, 403)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.scan('unknown').status_code, 429)
+            self.assertEqual(self.scan().status_code, 429)
+
+    @override_settings(
+        SCAN_ADDRESS_RATE_LIMIT=(60, 1), SCAN_ADDRESS_HEADER='HTTP_X_FORWARDED_FOR'
+    )
+    def test_address_behind_a_proxy(self):
+        def scan(forwarded_for):
+            return self.client.post(
+                reverse('register_scan'),
+                data={'device_id': 'door', 'card_id': b64encode(CARD).decode()},
+                content_type='application/json',
+                headers={'X-Forwarded-For': forwarded_for},
+            )
+
+        self.assertEqual(scan('10.0.0.1').status_code, 200)
+        self.assertEqual(scan('10.0.0.2').status_code, 200)
+        # the address the proxy added counts, not the one the client sent
+        self.assertEqual(scan('10.0.0.2, 10.0.0.1').status_code, 429)
+
+    @override_settings(SCAN_ADDRESS_RATE_LIMIT=(60, 0))
+    def test_address_burst_of_at_least_one(self):
+        self.assertEqual(self.scan().status_code, 200)
+        self.assertEqual(self.scan().status_code, 429)
+
+    @override_settings(SCAN_RATE_LIMIT=None)
+    def test_no_limit(self):
+        Scanner.objects.filter(pk='door').update(scan_burst=1)
+        for _ in range(3):
+            self.assertEqual(self.scan().status_code, 200)
+
+
+class SessionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('bob')
+        self.tag = Tag.objects.create(tag=CARD, name='card', owner=self.user)
+        self.monday = utils.start_of_day(date(2024, 3, 18))
+
+    def scan(self, type, hours):
+        save_log(
+            Log(type=type, tag=self.tag, time=self.monday + timedelta(hours=hours))
+        )
+
+    def sessions(self):
+        return [(s.start, s.end, s.duration) for s in Session.objects.order_by('start')]
+
+    def test_pairing(self):
+        self.scan('OUT', 8)  # nothing to close
+        self.scan('IN', 9)
+        self.scan('IN', 10)  # restarts the session
+        self.scan('OUT', 12)
+        self.scan('IN', 13)
+
+        def at(hours):
+            return self.monday + timedelta(hours=hours)
+
+        self.assertEqual(
+            self.sessions(),
+            [
+                (at(hours=10), at(hours=12), timedelta(hours=2)),
+                (at(hours=13), None, None),
+            ],
+        )
+        expected = self.sessions()
+        Session.objects.rebuild()
+        self.assertEqual(self.sessions(), expected)
+
+    def test_sessions_are_split_at_midnight(self):
+        self.scan('IN', 22)
+        self.scan('OUT', 26.5)
+        [session] = Session.objects.all()
+        self.assertEqual(session.duration, timedelta(hours=4.5))
+        monday, tuesday = date(2024, 3, 18), date(2024, 3, 19)
+        for first, last, minutes in [
+            (monday, monday, 120),
+            (tuesday, tuesday, 150),
+            (monday, tuesday, 270),
+        ]:
+            self.assertEqual(
+                Session.objects.minutes(self.user, *utils.day_range(first, last)),
+                minutes,
+            )
+
+
+class AsyncScanTests(TestCase):
+    def setUp(self):
+        scan_cache.clear()
+        cache.clear()
+        self.user = User.objects.create_user('bob', first_name='Bob')
+        Scanner.objects.create(id='door', name='Door')
+        Tag.objects.create(tag=CARD, name='card', owner=self.user)
+
+    async def scan(self, body):
+        return await self.async_client.post(
+            reverse('aregister_scan'), data=body, content_type='application/json'
+        )
+
+    async def test_scans_alternate(self):
+        body = {'device_id': 'door', 'card_id': b64encode(CARD).decode()}
+        states = []
+        with override_settings(SCAN_DEBOUNCE_SECONDS=0):
+            for _ in range(3):
+                response = await self.scan(body)
+                self.assertEqual(response.status_code, 200)
+                states.append(response.json()['state'])
+        self.assertEqual(states, ['checkin', 'checkout', 'checkin'])
+        self.assertEqual(await Log.objects.acount(), 3)
+        presence = await Presence.objects.aget(pk=self.user.pk)
+        self.assertEqual(presence.state, 'IN')
+
+    @override_settings(SCAN_WRITER=True)
+    async def test_the_write_doesnt_block_the_event_loop(self):
+        def slow_scan(scanner, tag, card_id):
+            time.sleep(0.2)
+            return 'claimed', JsonResponse({'state': 'checkin'})
+
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        body = {'device_id': 'door', 'card_id': b64encode(CARD).decode()}
+        with mock.patch.object(views, 'handle_scan', slow_scan):
+            response = await self.scan(body)
+        ticker.cancel()
+        self.assertEqual(response.json(), {'state': 'checkin'})
+        self.assertGreater(ticks, 5)
+
+    async def test_bad_requests(self):
+        response = await self.scan('{not json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['status'], 'error')
+        response = await self.scan({'device_id': 'door'})
+        self.assertEqual(response.status_code, 400)
+        response = await self.scan(
+            {'device_id': 'window', 'card_id': b64encode(CARD).decode()}
+        )
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(await Log.objects.aexists())
+
+
+class ScanCacheTests(TestCase):
+    def setUp(self):
+        scan_cache.clear()
+        self.user = User.objects.create_user('bob', first_name='Bob')
+        self.scanner = Scanner.objects.create(id='door', name='Door')
+        self.tag = Tag.objects.create(tag=CARD, name='card', owner=self.user)
+
+    def assertCached(self, get, key, cached):
+        with self.assertNumQueries(0 if cached else 1):
+            return get(key)
+
+    def test_scanners(self):
+        self.assertCached(scan_cache.get_scanner, 'door', False)
+        self.assertCached(scan_cache.get_scanner, 'door', True)
+        # unknown scanners too
+        self.assertCached(scan_cache.get_scanner, 'window', False)
+        self.assertIsNone(self.assertCached(scan_cache.get_scanner, 'window', True))
+
+        self.scanner.name = 'Front door'
+        self.scanner.save()
+        scanner = self.assertCached(scan_cache.get_scanner, 'door', False)
+        self.assertEqual(scanner.name, 'Front door')
+        self.scanner.delete()
+        self.assertIsNone(self.assertCached(scan_cache.get_scanner, 'door', False))
+
+    def test_unknown_scanners_dont_push_out_known_ones(self):
+        scan_cache.get_scanner('door')
+        with mock.patch.object(scan_cache.unknown_scanners, 'maxsize', 2):
+            for i in range(5):
+                self.assertIsNone(scan_cache.get_scanner(f'made-up-{i}'))
+        self.assertCached(scan_cache.get_scanner, 'door', True)
+        self.assertCached(scan_cache.get_scanner, 'made-up-4', True)
+        self.assertCached(scan_cache.get_scanner, 'made-up-0', False)
+
+    def test_lookups_get_their_own_instances(self):
+        first = scan_cache.get_tag(CARD)
+        first.owner.first_name = 'Changed'
+        second = self.assertCached(scan_cache.get_tag, CARD, True)
+        self.assertIsNot(second, first)
+        self.assertEqual(second.owner_name(), 'Bob')
+        self.assertFalse(second._state.adding)
+        scanner = self.assertCached(scan_cache.get_scanner, 'door', False)
+        self.assertIsNot(scan_cache.get_scanner('door'), scanner)
+
+    def test_tags(self):
+        self.assertCached(scan_cache.get_tag, CARD, False)
+        self.assertCached(scan_cache.get_tag, CARD, True)
+
+        self.tag.name = 'new name'
+        self.tag.save()
+        tag = self.assertCached(scan_cache.get_tag, CARD, False)
+        self.assertEqual(tag.name, 'new name')
+
+        # the owner is cached with the tag
+        self.user.first_name = 'Robert'
+        self.user.save()
+        tag = self.assertCached(scan_cache.get_tag, CARD, False)
+        self.assertEqual(tag.owner_name(), 'Robert')
+        self.user.save(update_fields=['last_login'])
+        self.assertCached(scan_cache.get_tag, CARD, True)
+
+        self.user.delete()
+        self.assertIsNone(self.assertCached(scan_cache.get_tag, CARD, False))
+
+
+class MembershipTests(TestCase):
+    def test_logs_are_attributed_to_the_subteam_of_their_time(self):
+        user = User.objects.create_user('bob')
+        tag = Tag.objects.create(tag=b'bob', owner=user)
+        software, hardware = SubTeam.objects.bulk_create(
+            [SubTeam(name='Software'), SubTeam(name='Hardware')]
+        )
+        now = timezone.now()
+        first = Membership.objects.create(
+            person=user, subteam=software, starting_from=now - timedelta(days=10)
+        )
+        second = Membership.objects.create(
+            person=user, subteam=hardware, starting_from=now - timedelta(days=5)
+        )
+        first.refresh_from_db()
+        self.assertEqual(first.valid_until, second.starting_from)
+        self.assertIsNone(second.valid_until)
+
+        old = Log.objects.create(tag=tag, type='IN', time=now - timedelta(days=7))
+        new = Log.objects.create(tag=tag, type='IN', time=now - timedelta(days=1))
+        logs = Log.objects.all()
+        self.assertEqual(list(Membership.objects.filter_logs(logs, software)), [old])
+        self.assertEqual(list(Membership.objects.filter_logs(logs, hardware)), [new])
+        self.assertEqual(
+            list(Membership.objects.filter_effective().filter(person=user)), [second]
+        )
+
+        second.delete()
+        first.refresh_from_db()
+        self.assertIsNone(first.valid_until)
+        self.assertEqual(
+            set(Membership.objects.filter_logs(logs, software)), {old, new}
+        )
+
+
+# the manifest storage needs collectstatic, which tests don't run
+plain_static_storage = override_settings(
+    STORAGES={
+        'staticfiles': {
+            'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'
+        }
+    }
+)
+
+
+class RunningTotalsTests(TestCase):
+    def setUp(self):
+        scan_cache.clear()
+        # rate limits and repeated scans
+        cache.clear()
+        self.user = User.objects.create_user('bob', first_name='Bob')
+        self.scanner = Scanner.objects.create(id='door', name='Door')
+        self.tag = Tag.objects.create(tag=CARD, name='card', owner=self.user)
+        # a Wednesday afternoon
+        self.now = utils.start_of_day(date(2024, 3, 20)) + timedelta(hours=15)
+        patcher = mock.patch('django.utils.timezone.now', return_value=self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tuesday = utils.start_of_day(date(2024, 3, 19))
+        for type, hours in [('IN', 22), ('OUT', 26), ('IN', 33), ('OUT', 34.5)]:
+            save_log(
+                Log(type=type, tag=self.tag, time=tuesday + timedelta(hours=hours))
+            )
+
+    def test_sessions_add_up_as_they_close(self):
+        presence = Presence.objects.get(pk=self.user.pk)
+        # the session past midnight counts 2 of its 4 hours for today
+        self.assertEqual(
+            presence.worked(), (timedelta(hours=3.5), timedelta(hours=5.5))
+        )
+        [expected] = Presence.objects.from_logs()
+        self.assertEqual(expected.worked(), presence.worked())
+
+    def test_reset_lazily(self):
+        presence = Presence.objects.get(pk=self.user.pk)
+        self.assertEqual(
+            presence.worked(date(2024, 3, 21)), (timedelta(), timedelta(hours=5.5))
+        )
+        self.assertEqual(presence.worked(date(2024, 3, 25)), (timedelta(), timedelta()))
+
+    def test_scan_response_without_aggregates(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(
+                reverse('register_scan'),
+                data={'device_id': 'door', 'card_id': b64encode(CARD).decode()},
+                content_type='application/json',
+            )
+        self.assertEqual(
+            response.json(),
+            {'state': 'checkin', 'name': 'Bob', 'dailyhours': 3.5, 'weeklyhours': 5.5},
+        )
+        sql = [q['sql'] for q in ctx.captured_queries]
+        self.assertFalse([q for q in sql if 'SUM(' in q or 'webui_statistics' in q])
+        # the presence written by the scan is reused for the response
+        self.assertFalse([q for q in sql if q.endswith('"person_id" = 1 LIMIT 21')])
+
+
+class RollupTests(TestCase):
+    def test_values(self):
+        user = User.objects.create_user('bob')
+        tag = Tag.objects.create(tag=CARD, name='card', owner=user)
+        monday = utils.start_of_day(date(2024, 3, 18))
+        # 180 minutes on Monday, 90 on Tuesday, 120 + 60 across Wednesday night
+        for start, end in [(9, 12), (24 + 10, 24 + 11.5), (48 + 22, 72 + 1)]:
+            for type, hours in [('IN', start), ('OUT', end)]:
+                save_log(Log(type=type, tag=tag, time=monday + timedelta(hours=hours)))
+        friday = monday + timedelta(days=4, hours=12)
+
+        with mock.patch('django.utils.timezone.now', return_value=friday):
+            Statistics.objects.rollup(date(2024, 3, 18), date(2024, 3, 21))
+            rows = Statistics.objects.filter(person=user).order_by('day')
+            self.assertEqual(
+                [(r.minutes_day, r.minutes_week, r.minutes_month) for r in rows],
+                [(180, 180, 180), (90, 270, 270), (120, 390, 390), (60, 450, 450)],
+            )
+            # (180 + 270 + 390 + 450) / 4, rounded down
+            self.assertEqual(
+                {(r.average_week, r.total_minutes) for r in rows}, {(322, 450)}
+            )
+
+            [friday_row] = Statistics.objects.rollup(date(2024, 3, 22))
+            self.assertEqual(friday_row.minutes_week, 450)
+            self.assertEqual(friday_row.average_week, (1290 + 450) // 5)
+            self.assertEqual(friday_row.total_minutes, 450)
+
+    def test_totals_select_people_with_a_subquery(self):
+        now = timezone.now()
+        for i in range(3):
+            user = User.objects.create_user(f'worker-{i}')
+            Session.objects.create(person=user, start=now - timedelta(hours=i + 1))
+        idle = User.objects.create_user('idle')
+
+        with CaptureQueriesContext(connection) as ctx:
+            rows = Statistics.objects.rollup(timezone.localdate())
+        self.assertEqual(len(rows), 3)
+        [totals] = [q['sql'] for q in ctx.captured_queries if 'AVG(' in q['sql']]
+        self.assertIn('IN (SELECT', totals)
+
+        # people asked for get a row even without sessions
+        [row] = Statistics.objects.rollup(timezone.localdate(), people=[idle])
+        self.assertEqual((row.minutes_day, row.total_minutes), (0, 0))
+
+
+class WorktimeTests(TestCase):
+    def test_matches_grouped_queries(self):
+        now = utils.start_of_day(date(2024, 3, 20)) + timedelta(hours=15)
+        rng = random.Random(0)
+        for i in range(5):
+            user = User.objects.create_user(f'worker-{i}')
+            time = now - timedelta(days=60)
+            sessions = []
+            while (start := time + timedelta(hours=rng.uniform(1, 40))) < now:
+                end = start + timedelta(hours=rng.uniform(0.1, 30))
+                sessions.append(Session(person=user, start=start, end=end))
+                time = end
+            # the last one is still open
+            sessions[-1].end = None
+            Session.objects.bulk_create(sessions)
+
+        first, last = date(2024, 2, 25), date(2024, 3, 20)
+        with mock.patch('django.utils.timezone.now', return_value=now):
+            rows = Statistics.objects.compute(first, last)
+            day = first
+            while day <= last:
+                end = utils.start_of_day(day + timedelta(days=1))
+                week = utils.start_of_day(day - timedelta(days=day.weekday()))
+                month = utils.start_of_day(day.replace(day=1))
+                for start, field in [
+                    (end - timedelta(days=1), 'minutes_day'),
+                    (week, 'minutes_week'),
+                    (month, 'minutes_month'),
+                ]:
+                    for person_id, minutes in Session.objects.minutes_by_person(
+                        start, end
+                    ).items():
+                        row = rows[person_id, day]
+                        self.assertEqual(getattr(row, field), minutes, (day, field))
+                day += timedelta(days=1)
+        self.assertEqual(len(rows), 5 * ((last - first).days + 1))
+
+    @override_settings(TIME_ZONE='Europe/Amsterdam')
+    def test_splits_at_midnights(self):
+        # the night of 2024-03-31 is an hour short
+        first, last = date(2024, 3, 30), date(2024, 4, 1)
+        midnight = [utils.start_of_day(first + timedelta(days=i)) for i in range(4)]
+        now = midnight[2] + timedelta(hours=10)
+        hour = 3600 * 10**6
+        sessions = [
+            # from before the range into its first day
+            (1, midnight[0] - timedelta(hours=5), midnight[0] + timedelta(hours=2)),
+            # over both nights
+            (1, midnight[0] + timedelta(hours=20), midnight[2] + timedelta(hours=1)),
+            # still open
+            (2, midnight[2] + timedelta(hours=7), None),
+            # after now and after the range, worth nothing
+            (2, now + timedelta(hours=1), None),
+            (3, midnight[3] + timedelta(hours=1), midnight[3] + timedelta(hours=2)),
+        ]
+        totals = worktime.cumulative_by_day(sessions, first, last, now)
+        self.assertEqual(
+            totals, {1: [0, 6 * hour, 29 * hour, 30 * hour], 2: [0, 0, 0, 3 * hour]}
+        )
+
+
+@plain_static_storage
+class LogHistoryTests(TestCase):
+    """Presences and sessions follow the logs, however they are written."""
+
+    def setUp(self):
+        self.user = User.objects.create_user('bob', is_staff=True, is_superuser=True)
+        self.tag = Tag.objects.create(tag=CARD, name='card', owner=self.user)
+        self.start = timezone.now() - timedelta(hours=8)
+        self.logs = [
+            save_log(Log(type=type, tag=self.tag, time=self.start + timedelta(hours=i)))
+            for i, type in enumerate(['IN', 'OUT', 'IN'])
+        ]
+        self.model_admin = admin.site._registry[Log]
+
+    def assertConsistent(self):
+        self.assertEqual(Presence.objects.inconsistencies(), [])
+        expected = list(Session.objects.values_list('start', 'end'))
+        Session.objects.rebuild()
+        self.assertEqual(list(Session.objects.values_list('start', 'end')), expected)
+
+    def test_record(self):
+        presence = Presence.objects.get(pk=self.user.pk)
+        self.assertEqual((presence.state, presence.last_log), ('IN', self.logs[2]))
+        # an older log arriving late doesn't change the current state
+        save_log(Log(type='OUT', tag=self.tag, time=self.start - timedelta(hours=1)))
+        presence.refresh_from_db()
+        self.assertEqual(presence.last_log, self.logs[2])
+
+    def test_rebuild_and_check(self):
+        call_command('rebuild_presence', '--check', stdout=io.StringIO())
+        Presence.objects.filter(pk=self.user.pk).update(state='OUT')
+        with self.assertRaisesMessage(CommandError, '1 inconsistent presence rows'):
+            call_command('rebuild_presence', '--check', stdout=io.StringIO())
+        call_command('rebuild_presence', stdout=io.StringIO())
+        self.assertEqual(Presence.objects.get(pk=self.user.pk).state, 'IN')
+        self.assertConsistent()
+
+    def test_admin_adds_logs(self):
+        log = Log(type='OUT', tag=self.tag, time=self.start + timedelta(hours=3))
+        self.model_admin.save_model(None, log, None, change=False)
+        self.assertEqual(Presence.objects.get(pk=self.user.pk).state, 'OUT')
+        # out of order
+        log = Log(type='OUT', tag=self.tag, time=self.start + timedelta(minutes=30))
+        self.model_admin.save_model(None, log, None, change=False)
+        self.assertEqual(Session.objects.filter(end=log.time).count(), 1)
+        self.assertConsistent()
+
+    def test_admin_changes_logs(self):
+        other = User.objects.create_user('carol')
+        log = self.logs[2]
+        log.tag = Tag.objects.create(tag=b'carol', name='card', owner=other)
+        self.model_admin.save_model(None, log, None, change=True)
+        self.assertEqual(Presence.objects.get(pk=self.user.pk).state, 'OUT')
+        self.assertEqual(Presence.objects.get(pk=other.pk).state, 'IN')
+        self.assertConsistent()
+
+    def test_admin_deletes_logs(self):
+        self.client.force_login(self.user)
+        log = self.logs[1]
+        response = self.client.post(
+            reverse('admin:webui_log_delete', args=[log.pk]), {'post': 'yes'}
+        )
+        self.assertEqual(response.status_code, 302)
+        # the first check-in was restarted by the second
+        [session] = Session.objects.all()
+        self.assertEqual((session.start, session.end), (self.logs[2].time, None))
+        self.assertConsistent()
+
+
+class RegisterScansTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('bob', first_name='Bob')
+        Scanner.objects.create(id='door', name='Door')
+        self.tag = Tag.objects.create(tag=CARD, name='card', owner=self.user)
+        self.now = timezone.now()
+
+    def upload(self, *scans):
+        """scans are (hours before now, idempotency key) pairs."""
+        return self.client.post(
+            reverse('register_scans'),
+            data=[
+                {
+                    'device_id': 'door',
+                    'card_id': b64encode(CARD).decode(),
+                    'scanned_at': (self.now - timedelta(hours=hours)).isoformat(),
+                    'idempotency_key': key,
+                }
+                for hours, key in scans
+            ],
+            content_type='application/json',
+        ).json()
+
+    def test_scans_are_decided_in_the_order_they_happened(self):
+        response = self.upload((1, 'b'), (3, 'a'), (0.5, 'c'))
+        self.assertEqual(
+            [result['state'] for result in response['results']],
+            ['checkout', 'checkin', 'checkin'],
+        )
+        closed, open_ = Session.objects.order_by('start')
+        self.assertEqual(closed.duration, timedelta(hours=2))
+        self.assertIsNone(open_.end)
+        self.assertEqual(Presence.objects.get(pk=self.user.pk).state, 'IN')
+
+    def test_duplicates_are_not_processed_again(self):
+        self.upload((3, 'a'), (1, 'b'))
+        response = self.upload((1, 'b'), (0.5, 'c'))
+        self.assertEqual(
+            response['results'],
+            [
+                {
+                    'status': 'success',
+                    'state': 'checkout',
+                    'name': 'Bob',
+                    'duplicate': True,
+                },
+                {'status': 'success', 'state': 'checkin', 'name': 'Bob'},
+            ],
+        )
+        self.assertEqual(Log.objects.count(), 3)
+
+    def test_late_scans_are_refused(self):
+        save_log(Log(type='IN', tag=self.tag, time=self.now - timedelta(hours=2)))
+        response = self.upload((3, 'a'), (1, 'b'))
+        late, on_time = response['results']
+        self.assertEqual(late['status'], 'error')
+        self.assertEqual(on_time['state'], 'checkout')
+        self.assertEqual(Log.objects.count(), 2)
+        [session] = Session.objects.all()
+        self.assertEqual(session.duration, timedelta(hours=1))
+
+    def test_scans_in_the_future_are_refused(self):
+        with override_settings(SCAN_CLOCK_SKEW=60):
+            response = self.upload((-0.5, 'a'), (0, 'b'))
+        future, now = response['results']
+        self.assertEqual(future['message'], 'Scan time is in the future')
+        self.assertEqual(now['state'], 'checkin')
+        self.assertEqual(Log.objects.count(), 1)
+
+    def test_scanner_rate_limit(self):
+        Scanner.objects.filter(pk='door').update(scans_per_minute=1, scan_burst=2)
+        before = metrics.SCANS.values['Door', 'rate_limited']
+        response = self.upload((3, 'a'), (2, 'b'), (1, 'c'))
+        self.assertEqual(
+            [result['status'] for result in response['results']],
+            ['success', 'success', 'error'],
+        )
+        self.assertEqual(metrics.SCANS.values['Door', 'rate_limited'], before + 1)
+        # uploading the same scans again costs nothing for the ones written
+        response = self.upload((3, 'a'), (2, 'b'), (1, 'c'))
+        self.assertEqual(response['results'][2]['status'], 'error')
+        cache.clear()
+        response = self.upload((3, 'a'), (2, 'b'), (1, 'c'))
+        self.assertEqual(response['results'][2]['state'], 'checkin')
+        self.assertEqual(Log.objects.count(), 3)
+
+    def test_scans_go_through_the_writer(self):
+        durations = metrics.SCAN_DURATION.values.get(('claimed',), [[0], 0])[0]
+        before = sum(durations)
+        with mock.patch.object(writer, 'run', wraps=writer.run) as run:
+            self.upload((3, 'a'), (1, 'b'))
+        run.assert_called_once_with(views.write_scans, mock.ANY)
+        durations = metrics.SCAN_DURATION.values[('claimed',)][0]
+        self.assertEqual(sum(durations), before + 2)
+
+    def test_late_logs_dont_end_sessions_before_they_start(self):
+        save_log(Log(type='IN', tag=self.tag, time=self.now))
+        save_log(Log(type='OUT', tag=self.tag, time=self.now - timedelta(hours=3)))
+        [session] = Session.objects.all()
+        self.assertEqual((session.start, session.end), (self.now, None))
+        self.assertEqual(Presence.objects.get(pk=self.user.pk).state, 'IN')
+
+
+class SchedulerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('bob')
+        self.tag = Tag.objects.create(tag=CARD, name='card', owner=self.user)
+        # a Wednesday afternoon
+        self.now = utils.start_of_day(date(2024, 3, 20)) + timedelta(hours=15)
+        patcher = mock.patch('django.utils.timezone.now', return_value=self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lease(self):
+        self.assertTrue(ScheduledTask.objects.claim('job', 'a', timeout=60))
+        self.assertFalse(ScheduledTask.objects.claim('job', 'b', timeout=60))
+        self.assertFalse(ScheduledTask.objects.claim('job', 'b', 60, force=True))
+
+        later = self.now + timedelta(minutes=5)
+        ScheduledTask.objects.release('job', 'a', later)
+        self.assertFalse(ScheduledTask.objects.claim('job', 'b', timeout=60))
+        self.assertTrue(ScheduledTask.objects.claim('job', 'b', 60, force=True))
+
+        # the lease of a worker that died expires
+        with mock.patch('django.utils.timezone.now', return_value=later):
+            self.assertTrue(ScheduledTask.objects.claim('job', 'a', timeout=60))
+
+    def test_runs_are_recorded(self):
+        def broken():
+            raise ValueError('oops')
+
+        task = scheduler.Task('broken', broken, interval=60, timeout=60)
+        with self.assertLogs('webui.scheduler', logging.ERROR):
+            run = scheduler.run(task, 'a')
+        self.assertFalse(run.succeeded)
+        self.assertIn('ValueError: oops', run.result)
+        # not due again until the interval has passed
+        self.assertIsNone(scheduler.run(task, 'a'))
+        self.assertEqual(
+            ScheduledTask.objects.get(name='broken').next_run,
+            self.now + timedelta(seconds=60),
+        )
+        self.assertEqual(TaskRun.objects.count(), 1)
+
+    def test_auto_checkout(self):
+        yesterday = utils.start_of_day(date(2024, 3, 19))
+        save_log(Log(type='IN', tag=self.tag, time=yesterday + timedelta(hours=10)))
+        today = self.now.replace(hour=0)
+        other = User.objects.create_user('carol')
+        tag = Tag.objects.create(tag=b'\x01', name='card', owner=other)
+        save_log(Log(type='IN', tag=tag, time=today + timedelta(hours=9)))
+
+        cutoff = today + timedelta(hours=4)
+        self.assertEqual(scheduler.last_cutoff(self.now), cutoff)
+        run = scheduler.run(scheduler.TASKS['auto_checkout'], 'a')
+        self.assertTrue(run.succeeded, run.result)
+
+        session = Session.objects.get(person=self.user)
+        self.assertEqual(session.end, cutoff)
+        self.assertEqual(Presence.objects.get(pk=self.user.pk).state, 'OUT')
+        # checked in after the cutoff: still there
+        self.assertEqual(Presence.objects.get(pk=other.pk).state, 'IN')
+
+    def test_auto_checkout_after_the_tag_changed_hands(self):
+        yesterday = utils.start_of_day(date(2024, 3, 19))
+        carol = User.objects.create_user('carol')
+        dave = User.objects.create_user('dave')
+        dave_tag = Tag.objects.create(tag=b'\x02', name='card', owner=dave)
+        for tag in [self.tag, dave_tag]:
+            save_log(Log(type='IN', tag=tag, time=yesterday + timedelta(hours=10)))
+        # bob's card went to carol and he got a new one; dave lost his
+        Tag.objects.filter(pk=self.tag.pk).update(owner=carol)
+        new_tag = Tag.objects.create(tag=b'\x03', name='new card', owner=self.user)
+        Tag.objects.filter(pk=dave_tag.pk).update(owner=None)
+
+        with mock.patch.object(scheduler, 'BATCH_SIZE', 1):
+            run = scheduler.run(scheduler.TASKS['auto_checkout'], 'a')
+        self.assertTrue(run.succeeded, run.result)
+
+        self.assertEqual(Presence.objects.get(pk=self.user.pk).state, 'OUT')
+        self.assertEqual(Log.objects.get(type='OUT').tag, new_tag)
+        self.assertFalse(Presence.objects.filter(pk=carol.pk).exists())
+        # nothing to check dave out with: skipped, once
+        self.assertEqual(Presence.objects.get(pk=dave.pk).state, 'IN')
+        self.assertEqual(Log.objects.count(), 3)
+
+
+@plain_static_storage
+class LogAdminTests(ViewTestCase):
+    def setUp(self):
+        super().setUp()
+        admin = User.objects.create_superuser('admin', password='secret')
+        self.client.force_login(admin)
+        now = timezone.now()
+        Log.objects.bulk_create(
+            Log(tag=self.tag, type='IN', time=now - timedelta(minutes=i))
+            for i in range(150)
+        )
+
+    def test_changelist_pages_by_cursor(self):
+        url = reverse('admin:webui_log_changelist')
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len(ctx.captured_queries), 8)
+        first = response.context['cl']
+        self.assertEqual(len(first.result_list), first.list_per_page)
+
+        response = self.client.get(url + first.older_url)
+        second = response.context['cl']
+        self.assertEqual(len(second.result_list), 152 - first.list_per_page)
+        self.assertIsNone(second.older_url)
+        self.assertLess(second.result_list[0].time, first.result_list[-1].time)
+
+    def test_person_filter(self):
+        url = reverse('admin:webui_log_changelist', query={'person': self.user.pk})
+        cl = self.client.get(url).context['cl']
+        self.assertEqual(cl.result_count_display, '152')
+
+    def test_invalid_cursor(self):
+        url = reverse('admin:webui_log_changelist', query={'before': 'nope'})
+        self.assertRedirects(
+            self.client.get(url),
+            reverse('admin:webui_log_changelist') + '?e=1',
+            fetch_redirect_response=False,
+        )
+
+
+@plain_static_storage
+class ArchiveTests(ViewTestCase):
+    def setUp(self):
+        super().setUp()
+        old = timezone.now() - timedelta(days=400)
+        save_logs(
+            [
+                Log(type=type, tag=self.tag, scanner=self.scanner, time=old + delta)
+                for type, delta in [('IN', timedelta()), ('OUT', timedelta(hours=2))]
+            ]
+        )
+        self.horizon = timezone.now() - timedelta(days=365)
+
+    def test_archive_moves_old_logs_only(self):
+        logs = list(Log.objects.order_by('time', 'pk').values_list('pk', 'type'))
+        sessions = list(Session.objects.values_list('start', 'duration'))
+
+        self.assertEqual(ArchivedLog.objects.archive(self.horizon), 2)
+        self.assertEqual(ArchivedLog.objects.archive(self.horizon), 0)
+        self.assertEqual(Log.objects.count(), 2)
+        self.assertEqual(Presence.objects.inconsistencies(), [])
+
+        # the archive keeps the ids, sessions rebuild the same from both tiers
+        archived = ArchivedLog.objects.order_by('time').values_list('pk', 'type')
+        live = Log.objects.order_by('time').values_list('pk', 'type')
+        self.assertEqual([*archived, *live], logs)
+        Session.objects.rebuild()
+        self.assertCountEqual(
+            Session.objects.values_list('start', 'duration'), sessions
+        )
+
+    def test_export_and_admin_read_both_tiers(self):
+        ArchivedLog.objects.archive(self.horizon)
+
+        response = self.client.get(reverse('export', query={'person': self.user.pk}))
+        rows = b''.join(response.streaming_content).decode().splitlines()[1:]
+        self.assertEqual([row.split(',')[1] for row in rows], ['IN', 'OUT'] * 2)
+
+        admin = User.objects.create_superuser('admin', password='secret')
+        self.client.force_login(admin)
+        response = self.client.get(reverse('admin:webui_log_changelist'))
+        cl = response.context['cl']
+        self.assertEqual([log.type for log in cl.result_list], ['OUT', 'IN'] * 2)
+        # archived logs keep their ids, they're counted once
+        self.assertEqual(cl.result_count_display, '4')
+        self.assertIsInstance(cl.result_list[-1], ArchivedLog)
+        change_url = reverse(
+            'admin:webui_archivedlog_change', args=[cl.result_list[-1].pk]
+        )
+        self.assertContains(response, change_url)
+        self.assertEqual(self.client.get(change_url).status_code, 200)
+
+
+class ExportTests(ViewTestCase):
+    def setUp(self):
+        super().setUp()
+        self.bob = User.objects.create_user('bob', first_name='Bob')
+        tag = Tag.objects.create(tag=b'bob', name='bob card', owner=self.bob)
+        hardware = SubTeam.objects.create(name='Hardware')
+        Membership.objects.create(
+            person=self.bob,
+            subteam=hardware,
+            starting_from=timezone.now() - timedelta(days=30),
+        )
+        self.hardware = hardware.pk
+        yesterday = utils.start_of_day(timezone.localdate() - timedelta(days=1))
+        save_logs(
+            [
+                Log(type=type, tag=tag, scanner=self.scanner, time=yesterday + delta)
+                for type, delta in [
+                    ('IN', timedelta(hours=9)),
+                    ('OUT', timedelta(hours=11)),
+                ]
+            ]
+        )
+
+    def export(self, **query):
+        response = self.client.get(reverse('export', query=query))
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def rows(self, **query):
+        """(first name, type) of the exported logs."""
+        content = b''.join(self.export(**query).streaming_content).decode()
+        header, *rows = csv.reader(io.StringIO(content))
+        self.assertEqual(header, list(views.EXPORT_FIELDS))
+        return [(row[3], row[1]) for row in rows]
+
+    def test_csv(self):
+        response = self.export()
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(
+            response['Content-Disposition'], 'attachment; filename="logs.csv"'
+        )
+        self.assertEqual(
+            self.rows(),
+            [('Bob', 'IN'), ('Bob', 'OUT'), ('Alice', 'IN'), ('Alice', 'OUT')],
+        )
+
+    def test_filters(self):
+        today = timezone.localdate().isoformat()
+        self.assertEqual(self.rows(start=today), [('Alice', 'IN'), ('Alice', 'OUT')])
+        self.assertEqual(self.rows(end=today, person=self.bob.pk)[0], ('Bob', 'IN'))
+        self.assertEqual(
+            self.rows(subteam=self.hardware), [('Bob', 'IN'), ('Bob', 'OUT')]
+        )
+        self.assertEqual(self.rows(type='OUT'), [('Bob', 'OUT'), ('Alice', 'OUT')])
+        ids = Log.objects.filter(type='IN').values_list('pk', flat=True)
+        self.assertEqual(self.rows(ids=list(ids)), [('Bob', 'IN'), ('Alice', 'IN')])
+
+    def test_gzip(self):
+        response = self.export(gzip='true')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertEqual(
+            response['Content-Disposition'], 'attachment; filename="logs.csv.gz"'
+        )
+        content = gzip.decompress(b''.join(response.streaming_content))
+        self.assertEqual(content, b''.join(self.export().streaming_content))
+
+    def test_staff_only(self):
+        self.client.force_login(self.bob)
+        self.assertEqual(self.client.get(reverse('export')).status_code, 403)
+
+
+class CurrentUserDataTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('bob')
+        self.client.force_login(self.user)
+        tag = Tag.objects.create(tag=CARD, name='card', owner=self.user)
+        start = utils.start_of_day(date(2024, 3, 18))
+        # two logs share a time: the cursor has to break the tie by id
+        hours = [8, 9, 9, 10, 11, 12, 13, 30]
+        logs = save_logs(
+            [Log(type='IN', tag=tag, time=start + timedelta(hours=h)) for h in hours]
+        )
+        self.newest_first = [
+            log.pk for log in sorted(logs, key=lambda log: (log.time, log.pk))
+        ][::-1]
+
+    def page(self, **query):
+        response = self.client.get(reverse('utable_data', query=query))
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return [log['id'] for log in data['logs']], data['before'], data['after']
+
+    def test_traversal(self):
+        ids, before, after = self.page(limit=3)
+        pages = [ids]
+        while before:
+            ids, before, _ = self.page(limit=3, before=before)
+            pages.append(ids)
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+        self.assertEqual(list(chain.from_iterable(pages)), self.newest_first)
+
+        # and back up from the oldest page
+        ids, _, after = self.page(limit=3, before=self.page(limit=5)[1])
+        self.assertEqual(ids, self.newest_first[5:])
+        ids, before, after = self.page(limit=3, after=after)
+        self.assertEqual(ids, self.newest_first[2:5])
+        self.assertEqual(self.page(limit=3, after=after)[0], self.newest_first[:2])
+        self.assertEqual(self.page(limit=3, before=before)[0], self.newest_first[5:])
+
+    def test_time_window(self):
+        ids, before, _ = self.page(start='2024-03-18', end='2024-03-18')
+        self.assertEqual(ids, self.newest_first[1:])
+        self.assertIsNone(before)
+
+    def test_invalid_cursors(self):
+        # not base64, no separator, not a time, not an id
+        cursors = ['~', 'bm9uc2Vuc2U=', 'eHwx', 'MjAyNC0wMy0xOHx4']
+        for cursor in cursors:
+            response = self.client.get(reverse('utable_data', query={'before': cursor}))
+            self.assertEqual(response.status_code, 400, cursor)
+            self.assertEqual(response.json()['status'], 'error')
+
+
+class StatisticsSeriesTests(ViewTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def get(self, start, end, unit='day'):
+        query = {'start': start, 'end': end, 'unit': unit}
+        response = self.client.get(reverse('statistics_series', query=query))
+        self.assertEqual(response.status_code, 200)
+        return [(b['label'], b['minutes']) for b in response.json()['series']]
+
+    def test_sessions_are_split_at_midnight_and_gaps_filled(self):
+        day = date(2024, 2, 28)
+        Session.objects.create(
+            person=self.user,
+            start=utils.start_of_day(day) + timedelta(hours=23),
+            end=utils.start_of_day(day) + timedelta(hours=25, minutes=30),
+        )
+        self.assertEqual(
+            self.get(day - timedelta(days=1), day + timedelta(days=2)),
+            [
+                ('2024-02-27', 0),
+                ('2024-02-28', 60),
+                ('2024-02-29', 90),
+                ('2024-03-01', 0),
+            ],
+        )
+        self.assertEqual(
+            self.get(day, day + timedelta(days=2), 'month'),
+            [('2024-02', 150), ('2024-03', 0)],
+        )
+        self.assertEqual(self.get(day, day, 'week'), [('2024-W09', 60)])
+
+    def test_cached_until_the_next_scan(self):
+        # start from someone who never scanned, the setup logs are in the future
+        Presence.objects.all().delete()
+        today = timezone.localdate()
+        yesterday = today - timedelta(days=1)
+        self.get(yesterday, today)
+        with CaptureQueriesContext(connection) as ctx:
+            self.get(yesterday, today)
+        self.assertFalse(
+            [q for q in ctx.captured_queries if 'webui_session' in q['sql']]
+        )
+
+        # a check-in counts right away, and keeps counting while open
+        save_log(Log(type='IN', tag=self.tag, time=timezone.now() - timedelta(hours=1)))
+        minutes = sum(m for _, m in self.get(yesterday, today))
+        self.assertGreaterEqual(minutes, 59)
+
+    def test_invalid_range(self):
+        today = timezone.localdate()
+        for query in [
+            {'start': today, 'end': today - timedelta(days=1)},
+            {'start': today - timedelta(days=1000), 'end': today},
+            {'start': today, 'end': today, 'unit': 'year'},
+        ]:
+            response = self.client.get(reverse('statistics_series', query=query))
+            self.assertEqual(response.status_code, 400)
+
+
+@plain_static_storage
+class QuotaReportTests(ViewTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.client.force_login(User.objects.create_superuser('admin'))
+        self.day = date(2024, 3, 6)
+        joined = utils.start_of_day(date(2024, 1, 1))
+        hardware = SubTeam.objects.create(name='Hardware')
+        part_time = Job.objects.create(name='Part-timer', quota=1)
+        for name, job, hours in [
+            ('bob', part_time, 2),
+            ('carol', None, 0),
+            ('dan', part_time, 0),
+        ]:
+            user = User.objects.create_user(name, first_name=name.title())
+            Membership.objects.create(
+                person=user, subteam=hardware, job=job, starting_from=joined
+            )
+            if hours:
+                start = utils.start_of_day(self.day) + timedelta(hours=9)
+                Session.objects.create(
+                    person=user,
+                    start=start,
+                    end=start + timedelta(hours=hours),
+                    duration=timedelta(hours=hours),
+                )
+
+    def test_report_is_one_query(self):
+        with self.assertNumQueries(1):
+            report = reports.build(self.day, 'week')
+        self.assertEqual((report['start'], report['end']), ('2024-03-04', '2024-03-10'))
+        # alice only joined now
+        [hardware] = report['subteams']
+        self.assertEqual(hardware['met'], 1)
+        self.assertEqual(
+            [
+                (m['username'], m['minutes'], m['quota'], m['met'])
+                for m in hardware['members']
+            ],
+            [('bob', 120, 60, True), ('carol', 0, None, None), ('dan', 0, 60, False)],
+        )
+        monthly = reports.build(self.day, 'month')['subteams'][0]['members']
+        self.assertEqual(monthly[0]['quota'], 4 * 60)
+
+    def test_endpoints(self):
+        query = {'unit': 'week', 'date': self.day}
+        data = self.client.get(reverse('quota_report', query=query)).json()
+        self.assertEqual(data['subteams'][0]['name'], 'Hardware')
+
+        response = self.client.get(reverse('quota_report', query={**query, 'csv': 1}))
+        lines = response.content.decode().splitlines()
+        self.assertEqual(lines[0], ','.join(reports.CSV_FIELDS))
+        self.assertEqual(lines[1], 'Hardware,Bob,bob,Part-timer,120,60,True')
+
+        response = self.client.get(reverse('admin:quota_report', query=query))
+        self.assertContains(response, '1 of 3 met their quota')
+
+        self.client.force_login(self.user)
+        self.user.is_staff = False
+        self.user.save()
+        response = self.client.get(reverse('quota_report', query=query))
+        self.assertEqual(response.status_code, 403)
+
+
+class EventsTests(ViewTestCase):
+    def test_hub_delivers_own_logs(self):
+        log = Log.objects.select_related('tag__owner').filter(tag=self.tag).first()
+
+        async def receive():
+            mine = events.hub.subscribe(self.user.pk)
+            others = events.hub.subscribe(self.user.pk + 1)
+            try:
+                await asyncio.to_thread(events.hub.publish, [log])
+                event = await asyncio.wait_for(mine.queue.get(), 1)
+                self.assertTrue(others.queue.empty())
+                return event
+            finally:
+                events.hub.unsubscribe(mine)
+                events.hub.unsubscribe(others)
+
+        event = asyncio.run(receive())
+        self.assertEqual(event['id'], log.id)
+        self.assertEqual(event['user_id'], self.user.pk)
+
+    def test_saving_publishes_on_commit(self):
+        with (
+            mock.patch.object(events.hub, 'publish') as publish,
+            self.captureOnCommitCallbacks(execute=True),
+        ):
+            log = save_log(Log(type='IN', tag=self.tag))
+        publish.assert_called_once_with([log])
+
+    def test_needs_asgi(self):
+        self.assertEqual(self.client.get(reverse('events')).status_code, 501)
+
+    def test_failed_replay_unsubscribes(self):
+        async def missed():
+            raise DatabaseError
+            yield
+
+        async def follow():
+            stream = views.event_stream(self.user.pk, missed())
+            with self.assertRaises(DatabaseError):
+                await anext(stream)
+
+        subscriptions = set(events.hub.subscriptions)
+        asyncio.run(follow())
+        self.assertEqual(events.hub.subscriptions, subscriptions)
+
+
+class OccupancyTests(ViewTestCase):
+    def setUp(self):
+        super().setUp()
+        occupancy.current.clear()
+
+    def scan(self, type, minutes):
+        # after the logs of setUpTestData
+        time = timezone.now() + timedelta(minutes=minutes)
+        with self.captureOnCommitCallbacks(execute=True):
+            save_log(Log(type=type, tag=self.tag, scanner=self.scanner, time=time))
+
+    def test_scans_update_occupancy_without_queries(self):
+        self.assertEqual(self.client.get(reverse('occupancy')).json()['total'], 0)
+
+        self.scan('IN', 5)
+        with self.assertNumQueries(0):
+            data = occupancy.current.get()
+        self.assertEqual(data['total'], 1)
+        [subteam] = data['subteams']
+        self.assertEqual(subteam['name'], 'Software')
+        self.assertEqual(subteam['people'][0]['name'], 'Alice Doe')
+
+        self.scan('OUT', 6)
+        with self.assertNumQueries(0):
+            self.assertEqual(occupancy.current.get()['total'], 0)
+
+    def test_matches_presence_after_reload(self):
+        self.scan('IN', 5)
+        expected = occupancy.current.get()
+        occupancy.current.clear()
+        self.assertEqual(occupancy.current.get(), expected)
+
+
+@override_settings(SCAN_WRITER=True)
+class WriterTests(TransactionTestCase):
+    def test_concurrent_scans_are_serialized(self):
+        scanner = Scanner.objects.create(id='door', name='Door')
+        user = User.objects.create_user('carol')
+        tag = Tag.objects.create(tag=b'carol', name='card', owner=user)
+
+        futures = [
+            writer.submit(views.write_scan, scanner, tag, b'carol') for _ in range(6)
+        ]
+        types = [future.result(timeout=10).type for future in futures]
+        self.assertEqual(types, ['IN', 'OUT'] * 3)
+        self.assertEqual(Log.objects.count(), 6)
+
+    def test_concurrent_repeats_are_written_once(self):
+        cache.clear()
+        scanner = Scanner.objects.create(id='door', name='Door')
+        user = User.objects.create_user('carol')
+        tag = Tag.objects.create(tag=b'carol', name='card', owner=user)
+
+        futures = [
+            writer.submit(views.handle_scan, scanner, tag, b'carol') for _ in range(4)
+        ]
+        outcomes = [future.result(timeout=10)[0] for future in futures]
+        self.assertEqual(outcomes, ['claimed'] + ['duplicate'] * 3)
+        self.assertEqual(Log.objects.count(), 1)
+
+    def test_uploads_and_scans_are_serialized(self):
+        cache.clear()
+        scanner = Scanner.objects.create(id='door', name='Door')
+        user = User.objects.create_user('carol')
+        tag = Tag.objects.create(tag=b'carol', name='card', owner=user)
+        upload = {
+            'device_id': 'door',
+            'card_id': b'carol',
+            'scanned_at': timezone.now() + timedelta(seconds=1),
+            'idempotency_key': 'a',
+        }
+
+        scan = writer.submit(views.handle_scan, scanner, tag, b'carol')
+        uploaded = writer.submit(views.write_scans, [upload])
+        self.assertEqual(scan.result(timeout=10)[0], 'claimed')
+        [result], _ = uploaded.result(timeout=10)
+        self.assertEqual(result['state'], 'checkout')
+
+    def test_status_changes_and_scans_are_serialized(self):
+        cache.clear()
+        scanner = Scanner.objects.create(id='door', name='Door')
+        user = User.objects.create_user('carol')
+        tag = Tag.objects.create(tag=b'carol', name='card', owner=user)
+
+        scan = writer.submit(views.write_scan, scanner, tag, b'carol')
+        toggled = writer.submit(views.toggle_status, tag)
+        self.assertEqual(scan.result(timeout=10).type, 'IN')
+        self.assertEqual(toggled.result(timeout=10).type, 'OUT')
+
+    def test_failing_job_doesnt_undo_the_others(self):
+        def fail():
+            Scanner.objects.create(id='x', name='X')
+            raise ValueError
+
+        first = writer.submit(Scanner.objects.create, id='a', name='A')
+        failing = writer.submit(fail)
+        last = writer.submit(Scanner.objects.create, id='b', name='B')
+        first.result(timeout=10)
+        last.result(timeout=10)
+        with self.assertRaises(ValueError):
+            failing.result(timeout=10)
+        self.assertEqual(set(Scanner.objects.values_list('id', flat=True)), {'a', 'b'})
@@ -12,8 +12,13 @@ urlpatterns = [
     path('change_status', views.change_status, name='change_status'),
     path('save_statistics', views.save_statistics, name='save_statistics'),
     path('get_statistics', views.get_statistics, name='get_statistics'),
+    path('statistics_series', views.statistics_series, name='statistics_series'),
     path('sign_up', views.sign_up, name='sign_up'),
     path('user_statistics', views.user_statistics, name='user_statistics'),
     path('user_profile', views.user_profile, name='user_profile'),
     path('export', views.export, name='export'),
+    path('quota_report', views.quota_report, name='quota_report'),
+    path('metrics', views.metrics_view, name='metrics'),
+    path('events', views.log_events, name='events'),
+    path('occupancy', views.current_occupancy, name='occupancy'),
 ]
@@ -1,5 +1,8 @@
+from datetime import datetime, timedelta
 from functools import wraps
+
 from django.http import JsonResponse
+from django.utils import timezone
 
 
 def require_authentication(view_func):
@@ -18,3 +21,27 @@ def require_authentication(view_func):
         return view_func(request, *args, **kwargs)
 
     return _wrapped_view
+
+
+def start_of_day(date):
+    """
+    Returns the aware datetime of local midnight at the start of date.
+    Filter on ranges of these instead of __date lookups, which can't use
+    an index.
+    """
+    return timezone.make_aware(datetime.combine(date, datetime.min.time()))
+
+
+def day_range(first, last):
+    """Returns the [start, end) datetime range covering dates first..last."""
+    return start_of_day(first), start_of_day(last + timedelta(days=1))
+
+
+def week_start(date):
+    """The Monday of the ISO week of date."""
+    return date - timedelta(days=date.weekday())
+
+
+def overlap(start, end, range_start, range_end):
+    """The part of [start, end) that falls in [range_start, range_end)."""
+    return max(timedelta(), min(end, range_end) - max(start, range_start))
@@ -0,0 +1,86 @@
+"""
+Time worked per person per day, from sessions, as NumPy array operations.
+
+Sessions are split at local midnights and added up in whole microseconds,
+like the database adds up durations, so sums over any run of days equal
+what Session.objects.minutes_by_person() returns for that range. Open
+sessions count until now. The one difference: a session that starts after
+now (a scanner clock running ahead) counts as nothing here, where the
+database subtracts it.
+"""
+
+from datetime import UTC, datetime, timedelta
+
+import numpy as np
+from django.utils import timezone
+
+from . import utils
+
+MICROSECOND = timedelta(microseconds=1)
+EPOCH = datetime(1970, 1, 1, tzinfo=UTC)
+
+
+def midnights(first, last):
+    """The aware local midnights at the start of first..last and after last."""
+    days = (last - first).days + 1
+    return [utils.start_of_day(first + timedelta(days=i)) for i in range(days + 1)]
+
+
+def microseconds(times):
+    """Microseconds since the epoch of aware datetimes, as an int64 array."""
+    return np.fromiter(
+        ((time - EPOCH) // MICROSECOND for time in times),
+        dtype=np.int64,
+        count=len(times),
+    )
+
+
+def cumulative_by_day(sessions, first, last, now=None):
+    """
+    sessions are (person_id, start, end) tuples, with end None while open.
+
+    Returns a dict of person ids to running totals of microseconds worked:
+    totals[i] is the time worked from the start of first to the start of
+    the i-th day after it, so day i is totals[i + 1] - totals[i].
+
+    The total at a midnight is what every session worked before it: the
+    midnight minus the start for the sessions still running then, plus the
+    whole length of the ones that ended. Both are counted with one entry
+    per session where it starts or ends running at a midnight and a
+    cumulative sum along the days, instead of walking through the days of
+    every session.
+    """
+    now = now or timezone.now()
+    bounds = microseconds(midnights(first, last))
+    sessions = list(sessions)
+    if not sessions:
+        return {}
+    people, starts, ends = zip(*sessions, strict=True)
+    # relative to the first midnight, so that sums stay far from overflowing
+    origin = bounds[0]
+    bounds -= origin
+    starts = np.maximum(microseconds(starts) - origin, 0)
+    ends = np.minimum(microseconds([end or now for end in ends]) - origin, bounds[-1])
+    kept = ends > starts
+    ids, rows = np.unique(np.asarray(people)[kept], return_inverse=True)
+    starts, ends = starts[kept], ends[kept]
+
+    # running from the first midnight after the start to the last one before
+    # the end, included; ended from the first midnight at or after the end
+    running_from = np.searchsorted(bounds, starts, side='right')
+    ended_from = np.searchsorted(bounds, ends, side='left')
+    shape = (len(ids), len(bounds))
+    running = np.zeros(shape, dtype=np.int64)
+    started = np.zeros(shape, dtype=np.int64)
+    ended = np.zeros(shape, dtype=np.int64)
+    np.add.at(running, (rows, running_from), 1)
+    np.add.at(running, (rows, ended_from), -1)
+    np.add.at(started, (rows, running_from), starts)
+    np.add.at(started, (rows, ended_from), -starts)
+    np.add.at(ended, (rows, ended_from), ends - starts)
+    totals = (
+        np.cumsum(running, axis=1) * bounds
+        - np.cumsum(started, axis=1)
+        + np.cumsum(ended, axis=1)
+    )
+    return dict(zip(ids.tolist(), totals.tolist(), strict=True))
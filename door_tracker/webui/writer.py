@@ -0,0 +1,109 @@
+"""
+Single writer thread for SQLite deployments.
+
+SQLite allows one writer at a time. With SCAN_WRITER on, the views that
+write on every scan hand their writes to one background thread instead of
+racing each other for the database lock. The thread runs whatever jobs
+are waiting in one transaction (each job in its own savepoint), so a burst
+of swipes costs one commit instead of one per swipe. Callers block until
+their job is committed, and get its result or exception.
+
+With SCAN_WRITER off (the default, and always with other databases), jobs
+run directly in the calling thread.
+
+The writes of register_scan, aregister_scan, register_scans,
+change_status and save_statistics go through the writer. These don't,
+and take the database lock themselves (IMMEDIATE, waiting up to
+busy_timeout):
+
+- Admin edits of logs, with the replays of presences and sessions they
+  cause. The admin runs them in a transaction of its own, which also
+  writes its change history. A writer job blocking inside it would wait
+  for that transaction's lock while holding it up.
+- The scheduler and the management commands (archive_logs, the rollups,
+  auto-checkout). They run in processes of their own, which this thread
+  isn't part of, and commit in short batches.
+- Logins, sign-ups and the rest of the admin, which are rare.
+"""
+
+import asyncio
+import contextvars
+import queue
+import threading
+from concurrent.futures import Future
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+
+class Writer:
+    def __init__(self, max_batch):
+        self.max_batch = max_batch
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'SCAN_WRITER', False)
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs) and return a Future of its result."""
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self.loop, name='scan-writer', daemon=True
+                )
+                self.thread.start()
+        future = Future()
+        # run in the caller's context, so its queries count for its request
+        context = contextvars.copy_context()
+        self.queue.put((future, context, fn, args, kwargs))
+        return future
+
+    def run(self, fn, *args, **kwargs):
+        if not self.enabled:
+            return fn(*args, **kwargs)
+        return self.submit(fn, *args, **kwargs).result()
+
+    async def arun(self, fn, *args, **kwargs):
+        if not self.enabled:
+            return await sync_to_async(fn)(*args, **kwargs)
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def loop(self):
+        while True:
+            jobs = [self.queue.get()]
+            while len(jobs) < self.max_batch:
+                try:
+                    jobs.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            close_old_connections()
+            self.commit(jobs)
+
+    def commit(self, jobs):
+        outcomes = []
+        try:
+            with transaction.atomic():
+                for future, context, fn, args, kwargs in jobs:
+                    try:
+                        with transaction.atomic():
+                            outcomes.append((True, context.run(fn, *args, **kwargs)))
+                    # whatever a job raises is its caller's, to re-raise
+                    except Exception as e:  # noqa: BLE001
+                        outcomes.append((False, e))
+        except Exception as e:  # noqa: BLE001
+            # the commit itself failed, none of the jobs happened
+            for future, *_ in jobs:
+                future.set_exception(e)
+            return
+        for (future, *_), (ok, value) in zip(jobs, outcomes, strict=True):
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+
+writer = Writer(getattr(settings, 'SCAN_WRITER_BATCH', 100))